@@ -0,0 +1,340 @@
+# coding: utf-8
+
+"""Benchmarks every filter of ImageWorker, and a few chains representative of real jobs, over synthetic images
+of several sizes and modes. Results can be saved as JSON and compared against a saved baseline:
+
+    python benchmark.py --save baseline.json
+    python benchmark.py --compare baseline.json --threshold 0.15
+    python benchmark.py --startup
+    python benchmark.py --threads 1 2 4 8 --cases sepia resize
+    python benchmark.py --quality --sizes large --modes RGB
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from os.path import dirname, abspath, join
+
+import numpy as np
+import PIL
+from PIL import Image
+
+from filter_image import ImageWorker, RESIZE_QUALITIES
+
+OVERLAY_PATH = join(dirname(abspath(__file__)), 'python.png')
+SCRIPT_PATH = join(dirname(abspath(__file__)), 'filter_image.py')
+
+SIZES = {
+    'small': (640, 480),
+    'medium': (1920, 1080),
+    'large': (4000, 3000),
+}
+MODES = ['L', 'RGB', 'RGBA', 'P']
+
+# {half} is replaced by half the width of the image, so resizes always shrink it
+FILTER_CASES = {
+    'rotate': ['rotate:30'],
+    'rotate_expand': ['rotate:30:true'],
+    'flip': ['flip:h'],
+    'gray_scale': ['gray_scale'],
+    'black_and_white': ['black_and_white:120'],
+    'resize': ['resize:{half}'],
+    'sepia': ['sepia:0.8'],
+    'overlay': ['overlay:' + OVERLAY_PATH + ':10,10'],
+}
+CHAIN_CASES = {
+    'thumbnail': ['resize:{half}', 'sepia'],
+    'watermark': ['rotate:30', 'resize:{half}', 'overlay:' + OVERLAY_PATH + ':10,10'],
+    'sepia_threshold': ['sepia:0.6', 'black_and_white:120'],
+    'geometric': ['rotate:30', 'flip:h', 'resize:{half}'],
+}
+
+# whole command line runs over a tiny image, where starting Python and importing modules is most of the time
+STARTUP_CASES = {
+    'flip': ['flip:h'],
+    'resize': ['resize:64'],
+    'sepia': ['sepia'],
+}
+
+
+# resizes of the quality benchmark shrink the image this many times, like making a preview
+QUALITY_SCALE = 8
+
+
+def synthetic_image(size: tuple, mode: str, seed: int = 0) -> Image:
+    """Deterministic gradients plus noise, built without any temporary bigger than the image itself"""
+    width, height = size
+    rng = np.random.default_rng(seed)
+    pixels = rng.integers(0, 64, size=(height, width, 3), dtype=np.uint8)
+    pixels[..., 0] += (np.arange(width) * 191 // max(width - 1, 1)).astype(np.uint8)[None, :]
+    pixels[..., 1] += (np.arange(height) * 191 // max(height - 1, 1)).astype(np.uint8)[:, None]
+    pixels[..., 2] += 96
+    image = Image.fromarray(pixels)
+
+    if mode == 'P':
+        palette_image = Image.fromarray(pixels[..., 0])
+        palette_image.putpalette(rng.integers(0, 256, size=768, dtype=np.uint8).tobytes())
+        return palette_image.convert('P')
+    if mode == 'RGBA':
+        image.putalpha(Image.linear_gradient('L').resize(size))
+    return image.convert(mode)
+
+
+def reset_peak_rss() -> bool:
+    """Resets the peak resident memory of the process, only possible on linux"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def max_rss() -> int:
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        # Windows, the peak memory is not measured there
+        return 0
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS bytes
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+
+def current_rss() -> int:
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return max_rss()
+
+
+def run_case(filters: list, size: tuple, mode: str, repeat: int, threads: int = 1) -> dict:
+    """Times a filter chain over a synthetic image. Meant to run in a fresh process, so the peak memory measured
+    belongs to this case only"""
+    image = synthetic_image(size, mode)
+    filters = [fta.replace('{half}', str(size[0] // 2)) for fta in filters]
+    worker = ImageWorker(operation={'filters': filters, 'threads': threads})
+
+    # without a way to reset the peak, only what goes above the peak of creating the image is seen
+    before = current_rss() if reset_peak_rss() else max_rss()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        worker.apply_filters(image)
+        timings.append(time.perf_counter() - start)
+
+    best = min(timings)
+    return {
+        'seconds': best,
+        'median_seconds': statistics.median(timings),
+        'megapixels_per_second': size[0] * size[1] / 1e6 / best if best else 0.0,
+        'peak_memory_mb': max(0, max_rss() - before) / 1024 / 1024,
+    }
+
+
+def psnr(image: Image, reference: Image) -> float:
+    """Peak signal to noise ratio in dB of an image against a reference of the same size and mode, inf when they
+    are the same. Images with transparency are compared premultiplied, the colors of pixels nobody sees count less"""
+    if image.mode in ['LA', 'RGBA']:
+        image, reference = [item.convert({'LA': 'La', 'RGBA': 'RGBa'}[item.mode]) for item in (image, reference)]
+    error = np.mean((np.asarray(image, dtype=np.float64) - np.asarray(reference, dtype=np.float64)) ** 2)
+    return float('inf') if error == 0 else float(10 * np.log10(255.0 ** 2 / error))
+
+
+def run_quality(size: tuple, mode: str, repeat: int) -> dict:
+    """Times every resize quality shrinking a synthetic image, with the PSNR of each result against the best one"""
+    image = synthetic_image(size, mode)
+    width = max(1, size[0] // QUALITY_SCALE)
+    reference = ImageWorker.resize(image, str(width))
+    results = {}
+    for quality in RESIZE_QUALITIES:
+        worker = ImageWorker(operation={'filters': ['resize:' + str(width) + '::' + quality]})
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = worker.apply_filters(image)
+            timings.append(time.perf_counter() - start)
+        best = min(timings)
+        results[quality] = {
+            'seconds': best,
+            'median_seconds': statistics.median(timings),
+            'megapixels_per_second': size[0] * size[1] / 1e6 / best if best else 0.0,
+            'psnr_db': psnr(result, reference),
+        }
+    return results
+
+
+def run_quality_benchmarks(sizes: list, modes: list, repeat: int) -> dict:
+    results = {}
+    for size_name in sizes:
+        for mode in modes:
+            for quality, result in run_quality(SIZES[size_name], mode, repeat).items():
+                key = 'resize/' + quality + '/' + mode + '/' + size_name
+                results[key] = result
+                print('%-40s %9.4fs %10.2f MP/s %9.1f dB' % (key, result['seconds'], result['megapixels_per_second'],
+                                                             result['psnr_db']))
+    return results
+
+
+def run_startup(filters: list, repeat: int) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        input_path = join(directory, 'input.png')
+        synthetic_image((128, 96), 'RGB').save(input_path)
+        command = [sys.executable, SCRIPT_PATH, '-i', input_path, '-o', 'result.png', '-n']
+        command += [argument for fta in filters for argument in ['-f', fta]]
+
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run(command, cwd=directory, check=True, stdout=subprocess.DEVNULL)
+            timings.append(time.perf_counter() - start)
+    return {'seconds': min(timings), 'median_seconds': statistics.median(timings)}
+
+
+def run_startup_benchmarks(cases: dict, repeat: int) -> dict:
+    results = {}
+    for case, filters in cases.items():
+        results['startup/' + case] = run_startup(filters, repeat)
+        print('%-40s %9.4fs (median %.4fs)' % ('startup/' + case, results['startup/' + case]['seconds'],
+                                              results['startup/' + case]['median_seconds']))
+    return results
+
+
+def run_benchmarks(sizes: list, modes: list, cases: dict, repeat: int = 3, isolated: bool = True,
+                   threads: list = None) -> dict:
+    """Runs every case for every size and mode. With a list of threads every case also runs with each number of
+    threads, and the key of the result ends with /t<threads>"""
+    jobs = {}
+    for case, filters in cases.items():
+        for size_name in sizes:
+            for mode in modes:
+                key = case + '/' + mode + '/' + size_name
+                if not threads:
+                    jobs[key] = (filters, SIZES[size_name], mode, repeat)
+                for number in threads or []:
+                    jobs[key + '/t' + str(number)] = (filters, SIZES[size_name], mode, repeat, number)
+
+    results = {}
+    if isolated:
+        for key, arguments in jobs.items():
+            # a new process for every case, max_tasks_per_child would need Python 3.11
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                results[key] = executor.submit(run_case, *arguments).result()
+            print_result(key, results[key])
+    else:
+        for key, arguments in jobs.items():
+            results[key] = run_case(*arguments)
+            print_result(key, results[key])
+    return results
+
+
+def print_result(key: str, result: dict):
+    print('%-40s %9.4fs %10.2f MP/s %9.1f MB' % (key, result['seconds'], result['megapixels_per_second'],
+                                                 result['peak_memory_mb']))
+
+
+def scaling(results: dict) -> dict:
+    """Speedup of every case run with several threads over the same case with a single thread"""
+    speedups = {}
+    for key, result in results.items():
+        case, _, threads = key.rpartition('/t')
+        single = results.get(case + '/t1')
+        if threads.isdigit() and single and result['seconds']:
+            speedups[key] = single['seconds'] / result['seconds']
+    return speedups
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Returns the cases slower than the baseline by more than the threshold, as a fraction (0.1 is 10%)"""
+    regressions = []
+    for key, result in results.items():
+        reference = baseline.get(key)
+        if not reference or not reference['seconds']:
+            continue
+        change = result['seconds'] / reference['seconds'] - 1
+        if change > threshold:
+            regressions.append((key, reference['seconds'], result['seconds'], change))
+    return regressions
+
+
+def environment() -> dict:
+    return {
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+    }
+
+
+def main(arguments: list):
+    parser = argparse.ArgumentParser(description='Benchmarks the filters of filter_image.py')
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES), default=list(SIZES))
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--cases', nargs='+', choices=list(FILTER_CASES) + list(CHAIN_CASES),
+                        help='cases to run, all of them by default')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every case, the best one is kept')
+    parser.add_argument('--in-process', action='store_true',
+                        help='faster, but memory still held by previous cases can hide the peak of a case')
+    parser.add_argument('--threads', nargs='+', type=int,
+                        help='runs every case with each number of threads and reports the speedup, like 1 2 4 8')
+    parser.add_argument('--startup', action='store_true',
+                        help='times whole command line runs of single filters over a tiny image instead')
+    parser.add_argument('--quality', action='store_true',
+                        help='times every resize quality instead, with the PSNR of its result against the best one')
+    parser.add_argument('--save', help='saves the results in this JSON file')
+    parser.add_argument('--compare', help='baseline JSON file to compare the results against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown over the baseline considered a regression, 0.1 is 10%%')
+    options = parser.parse_args(arguments)
+
+    cases = dict(FILTER_CASES, **CHAIN_CASES)
+    if options.cases:
+        cases = {name: cases[name] for name in options.cases}
+
+    if options.quality:
+        results = run_quality_benchmarks(options.sizes, options.modes, options.repeat)
+    elif options.startup:
+        cases = {name: STARTUP_CASES[name] for name in options.cases or STARTUP_CASES if name in STARTUP_CASES}
+        results = run_startup_benchmarks(cases, max(options.repeat, 5))
+    else:
+        results = run_benchmarks(options.sizes, options.modes, cases, options.repeat, not options.in_process,
+                                 options.threads)
+        for key, speedup in scaling(results).items():
+            print('%-40s %9.2fx' % (key, speedup))
+
+    if options.save:
+        with open(options.save, 'w') as output:
+            json.dump({'environment': environment(), 'results': results}, output, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline['results'], options.threshold)
+        for key, before, after, change in regressions:
+            print('REGRESSION %-40s %9.4fs -> %9.4fs (+%.0f%%)' % (key, before, after, change * 100))
+        if regressions:
+            return 1
+        print('No regressions above ' + '%.0f%%' % (options.threshold * 100))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,18 +1,301 @@
 # coding: utf-8
 
 import sys
-from os.path import exists, isfile
-from os import mkdir
+from os.path import exists, isfile, isdir, join, basename, splitext, dirname, abspath
+from os import makedirs, listdir, cpu_count, stat
+import os
 import collections
+import functools
+import hashlib
+import importlib
+import io
+import json
+import itertools
+import math
+import queue
+import shutil
+import tempfile
+import threading
+from glob import glob
 from PIL import Image
 import time
-import numpy as np
 
 
 def has_transparency(image: Image) -> bool:
     return image.mode in ['RGBA', 'LA'] or (image.mode == 'P' and 'transparency' in image.info)
 
 
+# affine matrices are kept the way PIL expects them, (a, b, c, d, e, f) mapping a point of the output image to
+# the point of the input image it is sampled from: x_in = a * x + b * y + c, y_in = d * x + e * y + f
+AFFINE_IDENTITY = (1.0, 0.0, 0.0, 0.0, 1.0, 0.0)
+
+
+def compose_affine(outer: tuple, inner: tuple) -> tuple:
+    """Returns the matrix of applying the filter described by outer and then the one described by inner"""
+    a1, b1, c1, d1, e1, f1 = outer
+    a2, b2, c2, d2, e2, f2 = inner
+    return (a1 * a2 + b1 * d2, a1 * b2 + b1 * e2, a1 * c2 + b1 * f2 + c1,
+            d1 * a2 + e1 * d2, d1 * b2 + e1 * e2, d1 * c2 + e1 * f2 + f1)
+
+
+def invert_affine(matrix: tuple) -> tuple:
+    a, b, c, d, e, f = matrix
+    determinant = a * e - b * d
+    return (e / determinant, -b / determinant, (b * f - c * e) / determinant,
+            -d / determinant, a / determinant, (c * d - a * f) / determinant)
+
+
+def transpose_affine(method, size: tuple) -> tuple:
+    """Matrix and output size equivalent to Image.transpose(method) on an image of the given size"""
+    w, h = size
+    matrices = {
+        None: (AFFINE_IDENTITY, (w, h)),
+        Image.Transpose.FLIP_LEFT_RIGHT: ((-1.0, 0.0, w, 0.0, 1.0, 0.0), (w, h)),
+        Image.Transpose.FLIP_TOP_BOTTOM: ((1.0, 0.0, 0.0, 0.0, -1.0, h), (w, h)),
+        Image.Transpose.ROTATE_90: ((0.0, -1.0, w, 1.0, 0.0, 0.0), (h, w)),
+        Image.Transpose.ROTATE_180: ((-1.0, 0.0, w, 0.0, -1.0, h), (w, h)),
+        Image.Transpose.ROTATE_270: ((0.0, 1.0, 0.0, -1.0, 0.0, h), (h, w)),
+        Image.Transpose.TRANSPOSE: ((0.0, 1.0, 0.0, 1.0, 0.0, 0.0), (h, w)),
+        Image.Transpose.TRANSVERSE: ((0.0, -1.0, w, -1.0, 0.0, h), (h, w)),
+    }
+    return matrices[method]
+
+
+def rotate_affine(size: tuple, angle: float, expand: bool, center: list = None) -> tuple:
+    """Matrix and output size equivalent to Image.rotate, the same math PIL does internally"""
+    w, h = size
+    if center is None:
+        center = (w / 2, h / 2)
+
+    angle = -math.radians(angle % 360.0)
+    a, b = round(math.cos(angle), 15), round(math.sin(angle), 15)
+    d, e = round(-math.sin(angle), 15), round(math.cos(angle), 15)
+    c = a * -center[0] + b * -center[1] + center[0]
+    f = d * -center[0] + e * -center[1] + center[1]
+
+    if expand:
+        xx = [a * x + b * y + c for x, y in ((0, 0), (w, 0), (w, h), (0, h))]
+        yy = [d * x + e * y + f for x, y in ((0, 0), (w, 0), (w, h), (0, h))]
+        nw = math.ceil(max(xx)) - math.floor(min(xx))
+        nh = math.ceil(max(yy)) - math.floor(min(yy))
+        c, f = a * -(nw - w) / 2.0 + b * -(nh - h) / 2.0 + c, d * -(nw - w) / 2.0 + e * -(nh - h) / 2.0 + f
+        w, h = nw, nh
+    return (a, b, c, d, e, f), (w, h)
+
+
+def find_transpose(matrix: tuple, source_size: tuple, size: tuple):
+    """Looks for a transpose that, followed by a plain resize, is exactly the given matrix. Returns the transpose
+    method (None when no transpose is needed) and the size of the transposed image, or None if there is none"""
+    for method in [None] + list(Image.Transpose):
+        transpose_matrix, transposed_size = transpose_affine(method, source_size)
+        remainder = compose_affine(invert_affine(transpose_matrix), matrix)
+        scale = (transposed_size[0] / size[0], 0.0, 0.0, 0.0, transposed_size[1] / size[1], 0.0)
+        if all(abs(value - expected) < 1e-6 for value, expected in zip(remainder, scale)):
+            return method, transposed_size
+    return None
+
+
+# the exact transposes done on numpy arrays of height x width (x bands) pixels, all of them return views of the
+# same memory instead of copies
+TRANSPOSE_VIEWS = {
+    None: lambda pixels: pixels,
+    Image.Transpose.FLIP_LEFT_RIGHT: lambda pixels: pixels[:, ::-1],
+    Image.Transpose.FLIP_TOP_BOTTOM: lambda pixels: pixels[::-1],
+    Image.Transpose.ROTATE_90: lambda pixels: pixels.swapaxes(0, 1)[::-1],
+    Image.Transpose.ROTATE_180: lambda pixels: pixels[::-1, ::-1],
+    Image.Transpose.ROTATE_270: lambda pixels: pixels.swapaxes(0, 1)[:, ::-1],
+    Image.Transpose.TRANSPOSE: lambda pixels: pixels.swapaxes(0, 1),
+    Image.Transpose.TRANSVERSE: lambda pixels: pixels[::-1, ::-1].swapaxes(0, 1),
+}
+
+
+@functools.lru_cache(maxsize=64)
+def sepia_matrix(ratio: float) -> 'np.ndarray':
+    import numpy as np
+    r = ratio
+    matrix = np.array([[0.393 + 0.607 * (1 - r), 0.769 - 0.769 * (1 - r), 0.189 - 0.189 * (1 - r)],
+                       [0.349 - 0.349 * (1 - r), 0.686 + 0.314 * (1 - r), 0.168 - 0.168 * (1 - r)],
+                       [0.272 - 0.349 * (1 - r), 0.534 - 0.534 * (1 - r), 0.131 + 0.869 * (1 - r)]],
+                      dtype=np.float32)
+    # the same array is handed to every caller, nobody should change it
+    matrix.flags.writeable = False
+    return matrix
+
+
+def sepia_pixels(image: Image, ratios: list) -> 'np.ndarray':
+    """Applies one or more sepia filters in a single pass over the image and returns the uint8 RGB or RGBA array"""
+    import numpy as np
+    # sepia only makes sense on rgb data, other modes are converted first and transparency is kept aside
+    if has_transparency(image):
+        image = image.convert('RGBA')
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+    return sepia_array(np.asarray(image), ratios)
+
+
+def sepia_array(pixels: 'np.ndarray', ratios: list) -> 'np.ndarray':
+    """Same as sepia_pixels for a uint8 array, gray pixels are spread to rgb the way PIL converts them"""
+    import numpy as np
+    if pixels.ndim == 2:
+        pixels = pixels[..., None]
+    if pixels.shape[-1] < 3:
+        pixels = np.concatenate([np.repeat(pixels[..., :1], 3, axis=2), pixels[..., 1:]], axis=2)
+
+    bands = pixels.shape[-1]
+    # batched products over a contiguous (pixels x 3) float32 view of the whole frame,
+    # instead of one matrix product per row over a float64 copy
+    filtered = pixels.reshape(-1, bands)[:, :3].astype(np.float32)
+    for index, ratio in enumerate(ratios):
+        if index:
+            # same truncation the uint8 image would get between two separate sepia filters
+            np.floor(filtered, out=filtered)
+        filtered = np.matmul(filtered, sepia_matrix(ratio).T)
+        np.clip(filtered, 0, 255, out=filtered)
+
+    result = np.empty(pixels.shape, dtype=np.uint8)
+    result.reshape(-1, bands)[:, :3] = filtered
+    if bands == 4:
+        result[..., 3] = pixels[..., 3]
+    return result
+
+
+@functools.lru_cache(maxsize=16)
+def overlay_layer(path: str, modified: int, size: int) -> Image:
+    """Decodes an overlay image once and keeps it ready to be composited, with its colors already multiplied by
+    its alpha. Cached by path, modification time and size so a changed file is decoded again"""
+    try:
+        foreground = Image.open(path)
+    except OSError:
+        raise Exception('No proper overlay image was given. Make sure you are providing a png '
+                        'image file with transparency.')
+
+    with foreground:
+        if not has_transparency(foreground):
+            raise ImageWithoutTransparencyError('The image provided for the overlay does not have transparency. '
+                                                'Please use an image with transparency to use this filter.')
+        layer = Image.new('RGBA', foreground.size)
+        layer.paste(foreground, (0, 0), mask=foreground.convert('RGBA'))
+    return layer
+
+
+@functools.lru_cache(maxsize=64)
+def color_table(parts: tuple) -> tuple:
+    """Runs the given filters over all the 256 possible gray values once, the result is a lookup table for any
+    image already reduced to a single channel. Returns the table and the mode of the images it produces"""
+    ramp = Image.frombytes('L', (256, 1), bytes(range(256)))
+    for name, parameters in parts:
+        ramp = FILTERS[name].function(ramp, *parameters)
+    return [value for band in ramp.split() for value in band.convert('L').tobytes()], ramp.mode
+
+
+# how much bigger than needed the image is kept when decoding it at a reduced scale, so the final LANCZOS resize
+# still has enough pixels to work with
+DECODE_REDUCING_GAP = 2.0
+
+
+def reduce_on_decode(image: Image, matrix: tuple) -> tuple:
+    """For images not decoded yet, when the matrix downscales them a lot, decodes JPEG files at 1/2, 1/4 or 1/8 of
+    their size with draft mode and box reduces other formats. Returns the image and the matrix adjusted to it"""
+    a, b, c, d, e, f = matrix
+    factor = min(math.hypot(a, d), math.hypot(b, e)) / DECODE_REDUCING_GAP
+    # only lazily opened files still have tiles to decode
+    if factor < 2 or not getattr(image, 'tile', None):
+        return image, matrix
+
+    source_size = image.size
+    if image.format == 'JPEG':
+        image.draft(image.mode, (math.ceil(source_size[0] / factor), math.ceil(source_size[1] / factor)))
+    remaining = int(factor * image.size[0] / source_size[0])
+    if remaining >= 2 and image.mode in ['L', 'LA', 'RGB', 'RGBA']:
+        image = image.reduce(remaining)
+
+    scale = (image.size[0] / source_size[0], 0.0, 0.0, 0.0, image.size[1] / source_size[1], 0.0)
+    return image, compose_affine(scale, matrix)
+
+
+# resampling filter and reducing gap of every resize quality, from the fastest to the most accurate. balanced box
+# reduces by an integer factor first, keeping at least twice the pixels LANCZOS needs, best runs LANCZOS on all of them
+RESIZE_QUALITIES = {
+    'nearest': (Image.NEAREST, None),
+    'bilinear': (Image.BILINEAR, None),
+    'fast': (Image.BOX, None),
+    'balanced': (Image.LANCZOS, 2.0),
+    'best': (Image.LANCZOS, None),
+}
+# Image.transform only samples with NEAREST, BILINEAR and BICUBIC, the closest one is used for the others
+TRANSFORM_RESAMPLE = {Image.BOX: Image.BILINEAR, Image.LANCZOS: Image.BICUBIC}
+
+
+def strip_bounds(height: int, parts: int, minimum_rows: int = 64) -> list:
+    """Splits the rows of an image into at most parts horizontal strips, none smaller than minimum_rows"""
+    rows = max(minimum_rows, -(-height // max(parts, 1)))
+    return [(top, min(top + rows, height)) for top in range(0, height, rows)]
+
+
+def resample_image(image: Image, size: tuple, resample=Image.LANCZOS, box: tuple = None,
+                   reducing_gap: float = None) -> Image:
+    """Image.resize, keeping the reducing gap for images with transparency. PIL premultiplies their alpha before
+    resizing them and drops the reducing gap when it does, so that is done here instead"""
+    if reducing_gap and image.mode in ['LA', 'RGBA'] and resample != Image.NEAREST:
+        premultiplied = image.convert({'LA': 'La', 'RGBA': 'RGBa'}[image.mode])
+        return premultiplied.resize(size, resample, box, reducing_gap).convert(image.mode)
+    return image.resize(size, resample, box, reducing_gap)
+
+
+def resize_image(image: Image, size: tuple, threads: int = 1, resample=Image.LANCZOS,
+                 reducing_gap: float = None) -> Image:
+    """Image.resize, with horizontal strips of the output resized on a pool of threads. Every strip is resized
+    from the box of the input it covers and PIL reads the pixels around the box its filter needs, so the rows
+    at the borders between strips get the same weights as in a single resize, up to rounding. NEAREST would pick
+    other source rows at the float borders and a reducing gap reduces every box on its own alignment, those are
+    not split"""
+    bounds = strip_bounds(size[1], threads)
+    if threads < 2 or len(bounds) < 2 or image.mode not in ['L', 'LA', 'RGB', 'RGBA', 'I', 'F'] \
+            or resample == Image.NEAREST or reducing_gap:
+        return resample_image(image, size, resample, reducing_gap=reducing_gap)
+
+    scale = image.size[1] / size[1]
+    image.load()
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        strips = list(executor.map(lambda rows: resample_image(
+            image, (size[0], rows[1] - rows[0]), resample, (0, rows[0] * scale, image.size[0], rows[1] * scale),
+            reducing_gap), bounds))
+    result = Image.new(image.mode, size)
+    for (top, _), strip in zip(bounds, strips):
+        result.paste(strip, (0, top))
+    return result
+
+
+def apply_affine(image: Image, matrix: tuple, size: tuple, resample=Image.NEAREST, threads: int = 1,
+                 reducing_gap: float = None) -> Image:
+    """Applies a composed affine matrix resampling the image at most once. Flips, multiples of 90 degrees and
+    resizes are done with exact transposes and a single resize with the given filter, anything else with one
+    Image.transform"""
+    transpose = find_transpose(matrix, image.size, size)
+    if transpose:
+        method, transposed_size = transpose
+        if transposed_size == size:
+            return image.transpose(method) if method is not None else image.copy()
+        if method is None:
+            return resize_image(image, size, threads, resample, reducing_gap)
+        if size[0] * size[1] < image.size[0] * image.size[1]:
+            # when shrinking, resize first so the transpose runs on the smaller image
+            swapped = method in [Image.Transpose.ROTATE_90, Image.Transpose.ROTATE_270,
+                                 Image.Transpose.TRANSPOSE, Image.Transpose.TRANSVERSE]
+            return resize_image(image, (size[1], size[0]) if swapped else size, threads, resample,
+                                reducing_gap).transpose(method)
+        return resize_image(image.transpose(method), size, threads, resample, reducing_gap)
+
+    a, b, c, d, e, f = matrix
+    # a single bicubic pass aliases on strong downscales, box reduce the input first to keep it within 2x
+    factor = int(min(math.hypot(a, d), math.hypot(b, e)))
+    if factor >= 2 and resample != Image.NEAREST and image.mode in ['L', 'LA', 'RGB', 'RGBA']:
+        image = image.reduce(factor)
+        matrix = tuple(value / factor for value in matrix)
+    return image.transform(size, Image.AFFINE, matrix, TRANSFORM_RESAMPLE.get(resample, resample))
+
+
 class KeyFlagInvokedMoreThanOnceError(Exception):
     """Raised when input or output flags are invoked more than once"""
     pass
@@ -58,6 +341,68 @@ class InvalidCommandEvokedError(Exception):
     pass
 
 
+class InvalidNumberOfJobsError(Exception):
+    """Raised when the number of parallel jobs given is not a positive int number"""
+    pass
+
+
+class InvalidMemoryBudgetError(Exception):
+    """Raised when the memory budget given for tiled execution is not a positive int number"""
+    pass
+
+
+class InvalidNumberOfThreadsError(Exception):
+    """Raised when the number of threads given for a single image is not a positive int number"""
+    pass
+
+
+class InvalidCacheSizeError(Exception):
+    """Raised when the size given for the result cache is not a positive int number"""
+    pass
+
+
+class InvalidEncoderOptionError(Exception):
+    """Raised when an option given for the output encoder does not exist for the format or has an invalid value"""
+    pass
+
+
+class InvalidWatchError(Exception):
+    """Raised when the watch mode is not given a directory to watch, an output name or a valid number of seconds
+    between scans"""
+    pass
+
+
+class InvalidStreamError(Exception):
+    """Raised when the stream read from stdin has an image that is not PNG, PPM or PGM, or ends in the middle of one"""
+    pass
+
+
+class InvalidRawFormatError(Exception):
+    """Raised when the size and mode given for raw frames are not like 1920x1080:RGB"""
+    pass
+
+
+class InvalidArrayError(Exception):
+    """Raised when the pixels given to filter_array are not uint8 with a shape or mode the filters understand"""
+    pass
+
+
+class InvalidServerAddressError(Exception):
+    """Raised when the address given for the server mode is not a port or a host:port pair"""
+    pass
+
+
+class FilterNotAllowedError(Exception):
+    """Raised when a request to the server asks for a filter reading files of the server, like overlay"""
+    pass
+
+
+class FilterNotImplementedError(Exception):
+    """Raised when a requested filter does not exist and the chain is validated strictly, like in the server mode.
+    The command line skips them instead"""
+    pass
+
+
 class InputParser:
     help_message = "-i or --input (required), arguments <path_to_original_image>. Example, -i input.jpg. " \
                    "If this flag is not specified, first argument will be looked at as a possible path.\n" \
@@ -66,28 +411,101 @@ class InputParser:
                    "-h or --help, will show this message with the available commands\n" \
                    "-o or --output (optional), arguments <path_to_output_image>, additional parameters possible " \
                    "separated by ':'. Example, -o ola:PNG will save the result in a PNG file called ola.png." \
-                   " If this flag is omitted result will be saved in result.jpg"
+                   " If this flag is omitted result will be saved in result.jpg. Animations and multi page inputs " \
+                   "keep all their frames when saved as gif, webp, png or tiff, -j sets the number of processes " \
+                   "filtering their frames. Encoder options can follow, " \
+                   "separated by ':', example -o thumb.jpg:quality=80:progressive or -o thumb:webp:fast. jpg takes " \
+                   "quality, progressive, optimize and subsampling, png compress_level and optimize, webp quality, " \
+                   "method and lossless, and all of them the fast and small presets (fast does not change jpg, its " \
+                   "defaults are already the fastest)\n" \
+                   "Batch mode: -i also accepts a directory, a glob pattern between quotes or a text file with one " \
+                   "path per line prefixed by @, example -i @paths.txt. Results are saved in a folder named after " \
+                   "the output name\n" \
+                   "Streaming: -i - reads concatenated PNG, PPM or PGM images from stdin and writes every result " \
+                   "to stdout as soon as it is ready, in the format given by -o, example -o -:png. Defaults to ppm, " \
+                   "raw writes only the pixels\n" \
+                   "-w or --watch (optional), arguments <seconds> (optional), with a directory as input keeps " \
+                   "processing the images that are new or changed since they were processed, checking the directory " \
+                   "every few seconds. Defaults to 2\n" \
+                   "-r or --raw (optional), arguments <width>x<height>:<mode>, with -i - reads raw frames of that " \
+                   "size and mode (L, LA, RGB or RGBA) instead, example -r 1920x1080:RGB\n" \
+                   "-j or --jobs (optional), arguments <number_of_processes>, number of images processed in " \
+                   "parallel in batch mode. Defaults to the number of cpus\n" \
+                   "-t or --threads (optional), arguments <number_of_threads>, splits every image in strips " \
+                   "filtered and resized in parallel. Defaults to 1\n" \
+                   "-n or --no-show (optional), does not open the resulting image in a viewer. Always on in batch " \
+                   "mode\n" \
+                   "-m or --memory (optional), arguments <megabytes>, runs the color filters strip by strip within " \
+                   "the given memory budget, keeping intermediate results in a memory mapped scratch file\n" \
+                   "-p or --profile (optional), arguments <path_to_file>, appends the time, cpu time and memory " \
+                   "spent decoding, in every filter, encoding and writing as JSON lines to the file, - for stdout\n" \
+                   "-c or --cache (optional), arguments <path_to_directory>, additional parameters possible " \
+                   "separated by ':'. Reuses results of the same input and filters kept in the directory, example -c " \
+                   "cache:2048 keeps up to 2048 megabytes of results. Defaults to 1024 megabytes\n" \
+                   "-s or --serve, arguments <port> or <host:port>, keeps running and applies filters to the " \
+                   "images posted to http://host:port/?f=<filter>&f=<filter>&format=png, answering with the result. " \
+                   "Host defaults to 127.0.0.1, -j sets the number of images processed at the same time"
     allowed_commands = {
         '-h': {'aliases': ['--help']},
         '-i': {'aliases': ['--input']},
         '-f': {'aliases': ['--filter']},
         '-o': {'aliases': ['--output']},
+        '-j': {'aliases': ['--jobs']},
+        '-t': {'aliases': ['--threads']},
+        '-r': {'aliases': ['--raw']},
+        '-w': {'aliases': ['--watch']},
+        '-n': {'aliases': ['--no-show']},
+        '-m': {'aliases': ['--memory']},
+        '-p': {'aliases': ['--profile']},
+        '-c': {'aliases': ['--cache']},
+        '-s': {'aliases': ['--serve']},
     }
-    accepted_output_formats = ['png', 'jpg', 'jpeg']
+    accepted_output_formats = ['png', 'jpg', 'jpeg', 'webp', 'gif', 'tif', 'tiff']
+    accepted_stream_formats = accepted_output_formats + ['ppm', 'raw']
+    glob_characters = ['*', '?', '[']
     arguments = None
 
     def __init__(self, untreated_arguments: list):
         self.requested_operation = self.translate(arguments=untreated_arguments)
 
-    def get_input_image(self):
+    def get_input_candidate(self):
         if '-i' in self.arguments:
             try:
-                candidate = self.arguments[self.arguments.index('-i') + 1]
+                return self.arguments[self.arguments.index('-i') + 1]
             except IndexError:
-                candidate = ""
-        else:
-            # if no flag -i is found, the program assumes the first argument should be the image
-            candidate = self.arguments[0]
+                return ""
+        # if no flag -i is found, the program assumes the first argument should be the image
+        return self.arguments[0]
+
+    def get_input_paths(self):
+        """Expands a directory, a glob pattern or an @file with one path per line into the list of images to
+        process. Returns None when the input is a single image"""
+        candidate = self.get_input_candidate()
+
+        if candidate.startswith('@'):
+            list_path = candidate[1:]
+            if not (exists(list_path) and isfile(list_path)):
+                raise FileNotFoundError('Provided list of inputs "' + list_path + '" does not exist')
+            with open(list_path) as list_file:
+                paths = [line.strip() for line in list_file]
+            return [path for path in paths if path and not path.startswith('#')]
+
+        if isdir(candidate):
+            extensions = Image.registered_extensions()
+            return sorted(join(candidate, name) for name in listdir(candidate)
+                          if splitext(name)[1].lower() in extensions and isfile(join(candidate, name)))
+
+        # an existing file is the image even when its name looks like a pattern, like photo[1].jpg
+        if isfile(candidate):
+            return None
+
+        if any(character in candidate for character in self.glob_characters):
+            return sorted(path for path in glob(candidate) if isfile(path))
+
+        return None
+
+    def get_input_image(self):
+        candidate = self.get_input_candidate()
 
         if exists(candidate) and isfile(candidate):
             try:
@@ -110,15 +528,19 @@ class InputParser:
                     pass
         return requested_filters
 
+    def get_output_parts(self) -> tuple:
+        """Splits the value of -o into the name, the format given after it if any, and the encoder options, like
+        thumb.jpg:quality=80:progressive or thumb:webp:fast"""
+        parts = self.arguments[self.arguments.index('-o') + 1].split(':')
+        if len(parts) > 1 and not is_encoder_option(parts[1]):
+            return parts[0], parts[1].lower(), parts[2:]
+        return parts[0], None, parts[1:]
+
     def get_output_image_name(self):
         if '-o' in self.arguments:
             try:
-                name = self.arguments[self.arguments.index('-o') + 1]
-                if ":" in name:
-                    parts = name.split(':')
-                    name = parts[0]
-                    file_format = parts[1].lower()
-
+                name, file_format, _ = self.get_output_parts()
+                if file_format:
                     if '.' in name:
                         name_parts = name.split('.')
 
@@ -140,7 +562,8 @@ class InputParser:
 
                 if file_format not in self.accepted_output_formats:
                     raise InvalidOutputFileExtensionProvidedError('Invalid output file extension error: provided '
-                                                                  'extension not acceptable, provide jpg or png')
+                                                                  'extension not acceptable, provide one of ' +
+                                                                  ', '.join(self.accepted_output_formats))
 
                 output_filename += "." + file_format
                 return output_filename
@@ -150,6 +573,138 @@ class InputParser:
         else:
             return 'result_' + str(int(time.time())) + '.jpg'
 
+    def get_encoder_options(self, output: str):
+        if '-o' not in self.arguments:
+            return {}
+        options = self.get_output_parts()[2]
+        return encoder_options(splitext(output)[1][1:], options) if options else {}
+
+    def get_number_of_jobs(self):
+        if '-j' not in self.arguments:
+            return None
+        try:
+            jobs = int(self.arguments[self.arguments.index('-j') + 1])
+        except (IndexError, ValueError):
+            jobs = 0
+        if jobs < 1:
+            raise InvalidNumberOfJobsError('Invalid number of jobs, please provide an int number bigger than 0')
+        return jobs
+
+    def get_watch_interval(self):
+        index = self.arguments.index('-w') + 1
+        # the number of seconds is optional, the next flag may follow
+        if index >= len(self.arguments) or self.arguments[index].startswith('-'):
+            return 2.0
+        try:
+            interval = float(self.arguments[index])
+        except ValueError:
+            interval = -1
+        if interval < 0:
+            raise InvalidWatchError('Invalid number of seconds between scans, please provide a number not '
+                                    'smaller than 0')
+        return interval
+
+    def get_watch_directory(self):
+        candidate = self.get_input_candidate()
+        if not isdir(candidate):
+            raise InvalidWatchError('The watch mode needs a directory as input, "' + candidate + '" is not one')
+        # the index keeps absolute paths, so it is the same whatever directory the command runs from
+        return abspath(candidate)
+
+    def get_raw_format(self):
+        if '-r' not in self.arguments:
+            return None
+        try:
+            value = self.arguments[self.arguments.index('-r') + 1]
+        except IndexError:
+            raise InvalidNumberOfArgumentsError('No size and mode were given for raw frames but -r flag was evoked.')
+        size, _, mode = value.partition(':')
+        try:
+            width, height = [int(part) for part in size.lower().split('x')]
+        except ValueError:
+            width = height = 0
+        if width < 1 or height < 1 or mode.upper() not in ARRAY_MODES.values():
+            raise InvalidRawFormatError('Invalid raw format "' + value + '", please provide the size and mode of the '
+                                        'frames like 1920x1080:RGB')
+        return width, height, mode.upper()
+
+    def get_stream_format(self):
+        if '-o' not in self.arguments:
+            return 'ppm', {}
+        try:
+            name, file_format, options = self.get_output_parts()
+        except IndexError:
+            raise OutputFlagEvokedWithoutValueError('No output value was given but -o flag was evoked.')
+        file_format = file_format or splitext(name)[1][1:].lower() or 'ppm'
+        if file_format not in self.accepted_stream_formats:
+            raise InvalidOutputFileExtensionProvidedError('Invalid output file extension error: provided extension '
+                                                          'not acceptable, provide one of ' +
+                                                          ', '.join(self.accepted_stream_formats))
+        return file_format, encoder_options(file_format, options) if options else {}
+
+    def get_number_of_threads(self):
+        if '-t' not in self.arguments:
+            return None
+        try:
+            threads = int(self.arguments[self.arguments.index('-t') + 1])
+        except (IndexError, ValueError):
+            threads = 0
+        if threads < 1:
+            raise InvalidNumberOfThreadsError('Invalid number of threads, please provide an int number bigger '
+                                              'than 0')
+        return threads
+
+    def get_memory_budget(self):
+        if '-m' not in self.arguments:
+            return None
+        try:
+            megabytes = int(self.arguments[self.arguments.index('-m') + 1])
+        except (IndexError, ValueError):
+            megabytes = 0
+        if megabytes < 1:
+            raise InvalidMemoryBudgetError('Invalid memory budget, please provide a number of megabytes bigger than 0')
+        return megabytes * 1024 * 1024
+
+    def get_profile_path(self):
+        if '-p' not in self.arguments:
+            return None
+        try:
+            return self.arguments[self.arguments.index('-p') + 1]
+        except IndexError:
+            raise InvalidNumberOfArgumentsError('No file was given for the profile but -p flag was evoked.')
+
+    def get_result_cache(self):
+        if '-c' not in self.arguments:
+            return None
+        try:
+            fields = self.arguments[self.arguments.index('-c') + 1].split(':')
+        except IndexError:
+            raise InvalidNumberOfArgumentsError('No directory was given for the cache but -c flag was evoked.')
+        if len(fields) < 2:
+            return ResultCache(fields[0])
+        try:
+            megabytes = int(fields[1])
+        except ValueError:
+            megabytes = 0
+        if megabytes < 1:
+            raise InvalidCacheSizeError('Invalid cache size, please provide a number of megabytes bigger than 0')
+        return ResultCache(fields[0], megabytes * 1024 * 1024)
+
+    def get_server_address(self):
+        try:
+            address = self.arguments[self.arguments.index('-s') + 1]
+        except IndexError:
+            raise InvalidNumberOfArgumentsError('No port was given for the server but -s flag was evoked.')
+        host, _, port = address.rpartition(':')
+        try:
+            port = int(port)
+        except ValueError:
+            port = -1
+        if not 0 <= port <= 65535:
+            raise InvalidServerAddressError('Invalid server address "' + address + '", please provide a port or '
+                                            'host:port')
+        return host or '127.0.0.1', port
+
     def translate(self, arguments: list):
         if not arguments:
             raise InvalidNumberOfArgumentsError('Invalid number of arguments.\n' + self.help_message)
@@ -173,29 +728,115 @@ class InputParser:
             raise KeyFlagInvokedMoreThanOnceError('Input flag evoked more than once. Please check your arguments')
         if counter.get('-o', 0) > 1:
             raise KeyFlagInvokedMoreThanOnceError('Output flag evoked more than once. Please check your arguments')
+        if counter.get('-j', 0) > 1:
+            raise KeyFlagInvokedMoreThanOnceError('Jobs flag evoked more than once. Please check your arguments')
+        if counter.get('-w', 0) > 1:
+            raise KeyFlagInvokedMoreThanOnceError('Watch flag evoked more than once. Please check your arguments')
+        if counter.get('-r', 0) > 1:
+            raise KeyFlagInvokedMoreThanOnceError('Raw flag evoked more than once. Please check your arguments')
+        if counter.get('-t', 0) > 1:
+            raise KeyFlagInvokedMoreThanOnceError('Threads flag evoked more than once. Please check your arguments')
+        if counter.get('-m', 0) > 1:
+            raise KeyFlagInvokedMoreThanOnceError('Memory flag evoked more than once. Please check your arguments')
+        if counter.get('-p', 0) > 1:
+            raise KeyFlagInvokedMoreThanOnceError('Profile flag evoked more than once. Please check your arguments')
+        if counter.get('-c', 0) > 1:
+            raise KeyFlagInvokedMoreThanOnceError('Cache flag evoked more than once. Please check your arguments')
+        if counter.get('-s', 0) > 1:
+            raise KeyFlagInvokedMoreThanOnceError('Serve flag evoked more than once. Please check your arguments')
 
         # looking for invalid commands
-        invalid = [arg for arg in self.arguments if arg.startswith('-') and arg not in self.allowed_commands.keys()]
+        # a lone - stands for the standard streams, -:<format> for stdout written in that format
+        invalid = [arg for arg in self.arguments
+                   if arg.startswith('-') and arg != '-' and not arg.startswith('-:')
+                   and arg not in self.allowed_commands.keys()]
         if invalid:
             raise InvalidCommandEvokedError('Invalid command ' + invalid[0] + '. Run with -h or --help '
                                                                               'flag for list of available commands.')
 
-        return {
-            'input': self.get_input_image(),
+        # the server takes its inputs, filters and output formats from every request
+        if '-s' in self.arguments:
+            return {
+                'serve': self.get_server_address(),
+                'jobs': self.get_number_of_jobs(),
+                'threads': self.get_number_of_threads(),
+                'memory_budget': self.get_memory_budget(),
+            }
+
+        # frames come from stdin and results go to stdout
+        if self.get_input_candidate() == '-':
+            stream_format, encoder = self.get_stream_format()
+            return {
+                'stream': True,
+                'filters': self.get_filters_to_apply(),
+                'raw': self.get_raw_format(),
+                'stream_format': stream_format,
+                'encoder': encoder,
+                'threads': self.get_number_of_threads(),
+                'memory_budget': self.get_memory_budget(),
+            }
+
+        output = self.get_output_image_name()
+        operation = {
             'filters': self.get_filters_to_apply(),
-            'output': self.get_output_image_name()
+            'output': output,
+            'encoder': self.get_encoder_options(output),
+            'show': '-n' not in self.arguments,
+            'jobs': self.get_number_of_jobs(),
+            'threads': self.get_number_of_threads(),
+            'memory_budget': self.get_memory_budget(),
+            'profile': self.get_profile_path(),
+            'cache': self.get_result_cache(),
         }
+        if '-w' in self.arguments:
+            # the default output name changes on every run, the results and their index need the same folder
+            if '-o' not in self.arguments:
+                raise InvalidWatchError('The watch mode needs an output name with -o, the folder where the results '
+                                        'and their index are kept')
+            operation['watch'] = self.get_watch_interval()
+            operation['watch_dir'] = self.get_watch_directory()
+            return operation
+        inputs = self.get_input_paths()
+        if inputs is None:
+            operation['input'] = self.get_input_image()
+        else:
+            operation['inputs'] = inputs
+        return operation
 
 
 class ImageWorker:
 
     def __init__(self, operation: dict):
         self.original_image = operation.get('input', None)
-        self.filters_to_apply = operation.get('filters', [])
+        # checked before anything is decoded, a mistake at the end of the chain should not cost a whole image
+        self.filters_to_apply = validate_chain(operation.get('filters', []))
         self.output = operation.get('output')
+        self.output_dir = operation.get('output_dir', 'results')
+        self.show = operation.get('show', True)
+        self.memory_budget = operation.get('memory_budget')
+        self.threads = operation.get('threads') or 1
+        # processes filtering the frames of an animation
+        self.jobs = operation.get('jobs') or 1
+        self.scratch_dir = operation.get('scratch_dir')
+        self.reduced_decode = operation.get('reduced_decode', True)
+        # either a function receiving the record of every stage or the path of a JSON lines file
+        profile = operation.get('profile')
+        self.cache = operation.get('cache')
+        # the image and the digest of its bytes, hashed once for all the cache keys of the image
+        self.digest = None
+        self.encoder_options = operation.get('encoder') or {}
+        # a BackgroundWriter encoding and writing the result while the caller moves on to the next image
+        self.writer = operation.get('writer')
+        self.profiler = StageProfiler(profile, input=getattr(self.original_image, 'filename', None) or None,
+                                      output=self.output) if profile else None
 
     @staticmethod
     def rotate(image: Image, angle: str = '45', expand: str = "false", center: str = None) -> Image:
+        angle, expd, coords = ImageWorker.rotate_arguments(angle, expand, center)
+        return image.rotate(angle=angle, expand=expd, center=coords)
+
+    @staticmethod
+    def rotate_arguments(angle: str = '45', expand: str = "false", center: str = None) -> tuple:
         try:
             angle = float(angle)
         except ValueError:
@@ -210,16 +851,27 @@ class ImageWorker:
                                  'filter rotate: "' + center + '", please provide two numbers.')
         else:
             coords = None
-        return image.rotate(angle=angle, expand=expd, center=coords)
+        return angle, expd, coords
+
+    @staticmethod
+    def rotate_transform(size: tuple, angle: str = '45', expand: str = "false", center: str = None) -> tuple:
+        return rotate_affine(size, *ImageWorker.rotate_arguments(angle, expand, center))
 
     @staticmethod
     def flip(image: Image, direction: str = "horizontal") -> Image:
+        return image.transpose(ImageWorker.flip_method(direction))
+
+    @staticmethod
+    def flip_method(direction: str = "horizontal"):
         if not isinstance(direction, str):
             direction = str(direction)
         if direction.lower() not in ['vertical', 'v', 'horizontal', 'h']:
             raise InvalidFlipDirectionError('Invalid direction provided for flip method: "' + direction + '"')
-        return image.transpose(
-            Image.FLIP_TOP_BOTTOM if direction.lower() in ['v', 'vertical'] else Image.FLIP_LEFT_RIGHT)
+        return Image.FLIP_TOP_BOTTOM if direction.lower() in ['v', 'vertical'] else Image.FLIP_LEFT_RIGHT
+
+    @staticmethod
+    def flip_transform(size: tuple, direction: str = "horizontal") -> tuple:
+        return transpose_affine(ImageWorker.flip_method(direction), size)
 
     @staticmethod
     def gray_scale(image: Image) -> Image:
@@ -227,6 +879,11 @@ class ImageWorker:
 
     @staticmethod
     def black_and_white(image: Image, threshold: str = '150') -> Image:
+        th = ImageWorker.black_and_white_threshold(threshold)
+        return image.convert('L').point(lambda x: 255 if x >= th else 0, mode='1')
+
+    @staticmethod
+    def black_and_white_threshold(threshold: str = '150') -> int:
         try:
             th = int(threshold)
         except ValueError:
@@ -236,10 +893,47 @@ class ImageWorker:
             th = 0
         if th > 255:
             th = 255
-        return image.convert('L').point(lambda x: 255 if x >= th else 0, mode='1')
+        return th
+
+    @staticmethod
+    def resize(image: Image, new_width: str, new_height: str = None, quality: str = None, mode: str = None) -> Image:
+        resample, reducing_gap = RESIZE_QUALITIES[ImageWorker.resize_quality(quality)]
+        return resample_image(image, ImageWorker.resize_size(image.size, new_width, new_height, mode), resample,
+                              reducing_gap=reducing_gap)
+
+    @staticmethod
+    def resize_size(size: tuple, new_width: str, new_height: str = None, mode: str = None) -> tuple:
+        nw, nh = ImageWorker.resize_arguments(new_width, new_height)
+        if nh is None:
+            return nw, int(nw * size[1] / size[0])
+        if ImageWorker.resize_mode(mode) == 'fit':
+            # the biggest size with the proportions of the image that fits in the box
+            scale = min(nw / size[0], nh / size[1])
+            return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+        return nw, nh
+
+    @staticmethod
+    def resize_quality(quality: str = None) -> str:
+        if not quality:
+            return 'best'
+        if quality.strip().lower() not in RESIZE_QUALITIES:
+            raise ValueError('Invalid quality provided for filter resize: "' + quality + '", please provide one '
+                             'of ' + ', '.join(RESIZE_QUALITIES) + '.')
+        return quality.strip().lower()
+
+    @staticmethod
+    def resize_mode(mode: str = None) -> str:
+        if not mode:
+            return 'stretch'
+        if mode.strip().lower() not in ['fit', 'stretch']:
+            raise ValueError('Invalid mode provided for filter resize: "' + mode + '", please provide fit or '
+                             'stretch.')
+        return mode.strip().lower()
 
     @staticmethod
-    def resize(image: Image, new_width: str, new_height: str = None) -> Image:
+    def resize_arguments(new_width: str, new_height: str = None, quality: str = None, mode: str = None) -> tuple:
+        ImageWorker.resize_quality(quality)
+        ImageWorker.resize_mode(mode)
         try:
             nw = int(new_width)
         except ValueError:
@@ -247,20 +941,26 @@ class ImageWorker:
                              'for filter resize: "' + new_width + '", please provide an int number.')
 
         if not new_height:
-            new_size = (nw, int(nw * image.size[1] / image.size[0]))
-        else:
-            try:
-                nh = int(new_height)
-                new_size = (nw, nh)
-            except ValueError:
-                raise ValueError('Invalid new height provided for filter resize: "'
-                                 '' + new_height + '", please provide an int number.')
+            return nw, None
+        try:
+            return nw, int(new_height)
+        except ValueError:
+            raise ValueError('Invalid new height provided for filter resize: "'
+                             '' + new_height + '", please provide an int number.')
 
-        return image.resize(new_size, Image.LANCZOS)
+    @staticmethod
+    def resize_transform(size: tuple, new_width: str, new_height: str = None, quality: str = None,
+                         mode: str = None) -> tuple:
+        new_size = ImageWorker.resize_size(size, new_width, new_height, mode)
+        return (size[0] / new_size[0], 0.0, 0.0, 0.0, size[1] / new_size[1], 0.0), new_size
 
     @staticmethod
     def sepia(image: Image, ratio: str = None) -> Image:
         # got this one from here https://yabirgb.com/blog/creating-a-sepia-filter-with-python/ and adapted
+        return Image.fromarray(sepia_pixels(image, [ImageWorker.sepia_ratio(ratio)]))
+
+    @staticmethod
+    def sepia_ratio(ratio: str = None) -> float:
         if not ratio:
             ratio = 1.0
         try:
@@ -272,78 +972,1360 @@ class ImageWorker:
             r = 0.0
         if r > 1:
             r = 1.0
-
-        np_image = np.array(image)
-        matrix = [[0.393 + 0.607 * (1 - r), 0.769 - 0.769 * (1 - r), 0.189 - 0.189 * (1 - r)],
-                  [0.349 - 0.349 * (1 - r), 0.686 + 0.314 * (1 - r), 0.168 - 0.168 * (1 - r)],
-                  [0.272 - 0.349 * (1 - r), 0.534 - 0.534 * (1 - r), 0.131 + 0.869 * (1 - r)]]
-
-        s_map = np.matrix(matrix)
-        filtered = np.array([x * s_map.T for x in np_image])
-        filtered[np.where(filtered > 255)] = 255
-        return Image.fromarray(filtered.astype('uint8'))
+        return r
 
     @staticmethod
     def overlay(image: Image, foreground_path: str, coordinates: str = None) -> Image:
-        if exists(foreground_path) and isfile(foreground_path):
-            try:
-                foreground = Image.open(foreground_path)
-            except OSError:
-                raise Exception('No proper overlay image was given. Make sure you are providing a png '
-                                'image file with transparency.')
-
-            if has_transparency(foreground):
-                fg_image_trans = Image.new('RGBA', image.size)
-                if not coordinates:
-                    # defaults to top left
-                    coords = [0, 0]
-                else:
-                    if ',' in coordinates:
-                        try:
-                            coords = [int(part) for part in coordinates.split(',')][:2]
-                            if coords[0] >= image.size[0] - foreground.size[0] * 0.5:
-                                coords[0] = image.size[0] - foreground.size[0]
-                            if coords[1] >= image.size[1] - foreground.size[1] * 0.5:
-                                coords[1] = image.size[1] - foreground.size[1]
-                        except Exception as e:
-                            raise InvalidOverlayCoordinatesError(str(e) + '. Invalid coordinates provided, write 2 '
-                                                                          'numbers separated by comma, like "100,200"')
-                    else:
-                        raise InvalidOverlayCoordinatesError('Invalid coordinates provided, write 2 numbers separated '
-                                                             'by comma, like "100,200"')
-                fg_image_trans.paste(foreground, coords, mask=foreground.convert('RGBA'))
-                return Image.alpha_composite(image.convert('RGBA'), fg_image_trans).convert('RGB')
-            else:
-                raise ImageWithoutTransparencyError('The image provided for the overlay does not have transparency. '
-                                                    'Please use an image with transparency to use this filter.')
-        else:
+        coords = ImageWorker.overlay_arguments(foreground_path, coordinates)
+        file_stat = stat(foreground_path)
+        foreground = overlay_layer(abspath(foreground_path), file_stat.st_mtime_ns, file_stat.st_size)
+
+        if coordinates:
+            if coords[0] >= image.size[0] - foreground.size[0] * 0.5:
+                coords[0] = image.size[0] - foreground.size[0]
+            if coords[1] >= image.size[1] - foreground.size[1] * 0.5:
+                coords[1] = image.size[1] - foreground.size[1]
+
+        if has_transparency(image):
+            # compositing changes the color of fully transparent pixels everywhere, go over the whole frame
+            fg_image_trans = Image.new('RGBA', image.size)
+            fg_image_trans.paste(foreground, coords)
+            return Image.alpha_composite(image.convert('RGBA'), fg_image_trans).convert('RGB')
+
+        # only the region under the foreground changes, the rest of the image is just copied
+        result = image.convert('RGB') if image.mode != 'RGB' else image.copy()
+        box = (max(coords[0], 0), max(coords[1], 0),
+               min(coords[0] + foreground.size[0], image.size[0]),
+               min(coords[1] + foreground.size[1], image.size[1]))
+        if box[0] < box[2] and box[1] < box[3]:
+            region = result.crop(box).convert('RGBA')
+            covered = foreground.crop((box[0] - coords[0], box[1] - coords[1],
+                                       box[2] - coords[0], box[3] - coords[1]))
+            result.paste(Image.alpha_composite(region, covered).convert('RGB'), box[:2])
+        return result
+
+    @staticmethod
+    def overlay_arguments(foreground_path: str, coordinates: str = None) -> list:
+        if not (exists(foreground_path) and isfile(foreground_path)):
             raise FileNotFoundError('Provided overlay path does not represent a path for an existing file')
+        if not coordinates:
+            # defaults to top left
+            return [0, 0]
+        if ',' not in coordinates:
+            raise InvalidOverlayCoordinatesError('Invalid coordinates provided, write 2 numbers separated '
+                                                 'by comma, like "100,200"')
+        try:
+            return [int(part) for part in coordinates.split(',')][:2]
+        except Exception as e:
+            raise InvalidOverlayCoordinatesError(str(e) + '. Invalid coordinates provided, write 2 '
+                                                          'numbers separated by comma, like "100,200"')
+
+    def plan(self) -> list:
+        """Groups the requested filters into the steps that will be executed, adjacent geometric filters are
+        merged into a single step so the image is only resampled once for all of them, and adjacent color
+        filters into a single step that goes over the pixels once"""
+        steps = []
+        for fta in self.filters_to_apply:
+            fields = fta.split(':')
+            filter_name, parameters = fields[0], fields[1:]
+
+            for step_class in [GeometricStep, ColorStep]:
+                if filter_name in step_class.filters:
+                    if not steps or not isinstance(steps[-1], step_class):
+                        steps.append(step_class(self.threads) if step_class is GeometricStep else step_class())
+                    steps[-1].add(filter_name, parameters)
+                    break
+            else:
+                steps.append(FilterStep(filter_name, parameters))
+        return steps
+
+    def measure(self, stage: str, function, image: Image = None, *arguments, **fields):
+        """Calls function(image, *arguments), recording it as a stage when profiling"""
+        if not self.profiler:
+            return function(image, *arguments)
+        return self.profiler.measure(stage, function, image, *arguments, **fields)
+
+    def decode(self, image: Image, steps: list) -> Image:
+        # looking ahead, when the chain starts by shrinking the image there is no need to decode it in full
+        if self.reduced_decode and steps and isinstance(steps[0], GeometricStep):
+            return steps[0].decode(image)
+        image.load()
+        return image
+
+    def group_steps(self, steps: list) -> list:
+        """With a memory budget or several threads consecutive pointwise steps are grouped to go through the image
+        strip by strip, the steps that need the whole frame, like the geometric ones, still run on their own"""
+        groups = []
+        for step in steps:
+            if (self.memory_budget or self.threads > 1) and step.tileable and groups and groups[-1][-1].tileable:
+                groups[-1].append(step)
+            else:
+                groups.append([step])
+        return groups
+
+    def source_digest(self, image: Image) -> str:
+        if self.digest is None or self.digest[0] is not image:
+            self.digest = (image, self.cache.source_digest(image))
+        return self.digest[1]
+
+    def prefix_key(self, image: Image, steps: list) -> str:
+        chain = [normalize_filter(fta) for step in steps for fta in step.chain]
+        return ResultCache.key('prefix', self.source_digest(image), str(self.reduced_decode), *chain)
+
+    def apply_filters(self, image: Image, steps: list = None) -> Image:
+        """Applies the chain to the image, steps already planned can be given to reuse them between images"""
+        result_image = image
+        steps = steps if steps is not None else self.plan()
+        done = 0
+        if self.cache:
+            # the longest prefix of the chain that was already computed for this input, if any
+            for position in range(len(steps), 0, -1):
+                if self.cache.checkpoint(steps[position - 1]):
+                    cached = self.cache.get(self.prefix_key(image, steps[:position]), '.png')
+                    if cached:
+                        result_image, done = Image.open(cached), position
+                        break
+
+        # only lazily opened files still have tiles to decode
+        if getattr(result_image, 'tile', None):
+            result_image = self.measure('decode', self.decode, result_image, steps[done:])
+
+        for group in self.group_steps(steps[done:]):
+            before = result_image
+            if group[0].tileable and self.memory_budget:
+                result_image = self.measure('filter', apply_tiled, result_image, group, self.memory_budget,
+                                            self.scratch_dir, self.threads,
+                                            filters=[fta for step in group for fta in step.chain])
+            elif group[0].tileable and self.threads > 1:
+                result_image = self.measure('filter', apply_threaded, result_image, group, self.threads,
+                                            filters=[fta for step in group for fta in step.chain])
+            else:
+                result_image = self.measure('filter', group[0].apply, result_image, filters=group[0].chain)
+            done += len(group)
+
+            if self.cache and self.cache.checkpoint(group[-1], before, result_image):
+                self.cache.put(self.prefix_key(image, steps[:done]), '.png', encode_image(result_image, 'prefix.png'))
+        return result_image
 
     def run(self):
         if not self.original_image or isinstance(self.original_image, str):
             raise InvalidPILImageCreatedError('The image provided does not exist or is invalid.')
 
-        result_image = self.original_image
-        for fta in self.filters_to_apply:
-            fields = fta.split(':')
-            filter_name = fields[0]
-            parameters = [result_image] + fields[1:]
+        output_path = join(self.output_dir, self.output)
+        if self.cache:
+            extension = splitext(output_path)[1].lower()
+            key = ResultCache.key('result', self.source_digest(self.original_image), extension,
+                                  str(self.reduced_decode), json.dumps(self.encoder_options, sort_keys=True),
+                                  *[normalize_filter(fta) for fta in self.filters_to_apply])
+            cached = self.cache.get(key, extension)
+            if cached:
+                # the same input and chain were already processed, no need to even decode the input
+                makedirs(dirname(output_path) or '.', exist_ok=True)
+                self.measure('cache', shutil.copyfile, cached, output_path)
+                if self.show:
+                    Image.open(output_path).show()
+                return output_path
+
+        if is_multi_frame(self.original_image, output_path):
+            data = self.measure('encode', encode_frames, self.filter_frames(self.original_image), output_path,
+                                self.encoder_options, self.original_image.info.get('loop'))
+            self.measure('write', write_file, data, output_path)
+            if self.cache:
+                self.cache.put(key, extension, data)
+            if self.show:
+                Image.open(output_path).show()
+            return output_path
+
+        result_image = self.apply_filters(self.original_image)
+
+        if self.show:
+            result_image.show()
+        if self.writer:
+            # the input is closed by the caller once this returns, the result must not depend on it
+            if result_image is self.original_image:
+                result_image = result_image.copy()
+            self.writer.submit(output_path, self.save, result_image, output_path, key if self.cache else None)
+        else:
+            self.save(result_image, output_path, key if self.cache else None)
+        return output_path
+
+    def filter_frames(self, image: Image):
+        """Yields every frame of the image with the filters applied, in order, together with its duration and
+        disposal. With several jobs the frames are filtered by a pool of processes, a few of them ahead of the one
+        being encoded, so frames are only decoded as the encoder asks for them. The gif and tiff encoders do not
+        keep them all, the webp and png ones do"""
+        options = {'filters': self.filters_to_apply, 'memory_budget': self.memory_budget,
+                   'scratch_dir': self.scratch_dir, 'threads': self.threads}
+        frames = ((frame, timing, options) for frame, timing in read_frames(image))
+        if self.jobs == 1:
+            yield from (filter_frame(*arguments) for arguments in frames)
+            return
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=min(self.jobs, image.n_frames)) as executor:
+            yield from map_bounded(executor, filter_frame, frames, self.jobs * 2)
+
+    def save(self, image: Image, output_path: str, key: str = None):
+        data = self.measure('encode', encode_image, image, output_path, self.encoder_options)
+        self.measure('write', write_file, data, output_path)
+        if key:
+            self.cache.put(key, splitext(output_path)[1].lower(), data)
+
+
+class FilterDefinition:
+    """Declares a filter: the names of its parameters and how many of them are required, the function checking
+    their values without any image, and the modules it needs. Those are only imported when a chain uses it"""
+
+    def __init__(self, name: str, function, parameters: list = (), required: int = 0, check=None,
+                 transform=None, requires: list = ()):
+        self.name = name
+        self.function = function
+        self.parameters = list(parameters)
+        self.required = required
+        self.check = check
+        self.transform = transform
+        self.requires = list(requires)
+
+    def validate(self, parameters: list) -> bool:
+        """False when the number of parameters is wrong, the errors of the filter itself when a value is"""
+        if not self.required <= len(parameters) <= len(self.parameters):
+            return False
+        if self.check:
+            self.check(*parameters)
+        for module in self.requires:
+            try:
+                importlib.import_module(module)
+            except ImportError:
+                raise ImportError('Filter "' + self.name + '" needs the ' + module + ' module, install it with '
+                                  'pip install ' + module)
+        return True
+
+
+FILTERS = {definition.name: definition for definition in [
+    FilterDefinition('rotate', ImageWorker.rotate, ['angle', 'expand', 'center'],
+                     check=ImageWorker.rotate_arguments, transform=ImageWorker.rotate_transform),
+    FilterDefinition('flip', ImageWorker.flip, ['direction'],
+                     check=ImageWorker.flip_method, transform=ImageWorker.flip_transform),
+    FilterDefinition('gray_scale', ImageWorker.gray_scale),
+    FilterDefinition('black_and_white', ImageWorker.black_and_white, ['threshold'],
+                     check=ImageWorker.black_and_white_threshold),
+    FilterDefinition('resize', ImageWorker.resize, ['new_width', 'new_height', 'quality', 'mode'], required=1,
+                     check=ImageWorker.resize_arguments, transform=ImageWorker.resize_transform),
+    FilterDefinition('sepia', ImageWorker.sepia, ['ratio'], check=ImageWorker.sepia_ratio, requires=['numpy']),
+    FilterDefinition('overlay', ImageWorker.overlay, ['foreground_path', 'coordinates'], required=1,
+                     check=ImageWorker.overlay_arguments),
+]}
+
+
+def validate_chain(filters: list, strict: bool = False) -> list:
+    """Checks every filter of the chain before any image is touched. Filters that do not exist or get the wrong
+    number of parameters are skipped with a message, or raise when strict. Invalid values always raise"""
+    valid = []
+    for fta in filters:
+        fields = fta.split(':')
+        definition = FILTERS.get(fields[0])
+        if definition is None:
+            if strict:
+                raise FilterNotImplementedError(fields[0] + ' is not implemented (yet!)')
+            print(fields[0] + ' is not implemented (yet!)')
+        elif not definition.validate(fields[1:]):
+            if strict:
+                raise InvalidNumberOfArgumentsError('Invalid number of arguments passed to filter "' + fields[0] + '"')
+            print('Invalid number of arguments passed to filter "' + fields[0] + '". \
+            Program will skip applying this filter to the resulting image.')
+        else:
+            valid.append(fta)
+    return valid
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for block in iter(lambda: source.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def normalize_filter(fta: str) -> str:
+    """Spelling of a filter used in cache keys: no surrounding spaces or trailing empty parameters, and overlays
+    identified by the content of the foreground file instead of its path"""
+    fields = [field.strip() for field in fta.split(':')]
+    while len(fields) > 1 and not fields[-1]:
+        fields.pop()
+    if fields[0] == 'overlay' and len(fields) > 1 and isfile(fields[1]):
+        fields[1] = file_digest(fields[1])
+    return ':'.join(fields)
 
-            if hasattr(self, filter_name):
+
+# modes a prefix can be kept in, the ones PNG stores losslessly
+PREFIX_MODES = ['1', 'L', 'LA', 'I', 'I;16', 'P', 'RGB', 'RGBA']
+
+
+class ResultCache:
+    """Content addressed cache of results on disk, keyed by the digest of the input bytes, the normalized filter
+    chain and the output format. Images shrunk by a geometric step are also kept as prefixes, so chains starting
+    the same way reuse them. The least recently used entries are removed when the total size goes over the limit.
+    The total is kept in a size file every process using the cache appends to, so the entries are only listed when
+    it goes over the limit"""
+
+    size_name = '.size'
+
+    def __init__(self, directory: str, max_bytes: int = 1024 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # the size file as far as this instance read it: its inode, the position reached and the total up to there
+        self.size_file = None
+        self.offset = 0
+        self.total = None
+
+    @staticmethod
+    def key(*parts) -> str:
+        return hashlib.sha256('\0'.join(parts).encode()).hexdigest()
+
+    @staticmethod
+    def source_digest(image: Image) -> str:
+        # files are identified by their bytes, without decoding them, images in memory by their pixels
+        filename = getattr(image, 'filename', None)
+        if filename and isfile(filename):
+            return file_digest(filename)
+        return hashlib.sha256(image.mode.encode() + str(image.size).encode() + image.tobytes()).hexdigest()
+
+    @staticmethod
+    def checkpoint(step, before: Image = None, after: Image = None) -> bool:
+        """Prefixes are only kept after geometric steps that shrink the image, the ones worth skipping, and only in
+        modes PNG can store"""
+        if not isinstance(step, GeometricStep):
+            return False
+        if before is None or after is None:
+            return True
+        return after.mode in PREFIX_MODES and after.size[0] * after.size[1] < before.size[0] * before.size[1]
+
+    def path(self, key: str, extension: str) -> str:
+        return join(self.directory, key[:2], key + extension)
+
+    def get(self, key: str, extension: str):
+        path = self.path(key, extension)
+        try:
+            # the modification time is the last use, the eviction goes by it
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def put(self, key: str, extension: str, data: bytes) -> str:
+        path = self.path(key, extension)
+        write_file(data, path)
+        if not isfile(join(self.directory, self.size_name)):
+            # first put into the cache, or one written before the size file existed, the entries are counted once
+            self.evict()
+        elif self.add_size(len(data)) > self.max_bytes:
+            # the scan also corrects the total for overwritten entries
+            self.evict()
+        return path
+
+    def add_size(self, size: int) -> int:
+        """Appends the size of a new entry to the size file and returns the total of the cache, reading only the
+        lines other processes appended since the last call"""
+        size_path = join(self.directory, self.size_name)
+        # lines this short are appended in one piece by every process
+        descriptor = os.open(size_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(descriptor, (str(size) + '\n').encode())
+        finally:
+            os.close(descriptor)
+        with open(size_path, 'rb') as size_file:
+            inode = os.fstat(size_file.fileno()).st_ino
+            if inode != self.size_file:
+                # replaced by an eviction since it was last read
+                self.size_file, self.offset, self.total = inode, 0, 0
+            size_file.seek(self.offset)
+            for line in size_file:
+                if not line.endswith(b'\n'):
+                    # still being appended
+                    break
+                self.offset += len(line)
+                self.total += int(line)
+        return self.total
+
+    def evict(self):
+        entries = []
+        for folder in listdir(self.directory):
+            if not isdir(join(self.directory, folder)):
+                continue
+            for name in listdir(join(self.directory, folder)):
                 try:
-                    result_image = getattr(self, filter_name)(*parameters)
-                except TypeError:
-                    print('Invalid number of arguments passed to filter "' + filter_name + '". \
-                    Program will skip applying this filter to the resulting image.')
+                    entry_stat = stat(join(self.directory, folder, name))
+                except OSError:
+                    continue
+                entries.append((entry_stat.st_mtime, entry_stat.st_size, join(self.directory, folder, name)))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # another process removed it already
+                pass
+            total -= size
+        # the size file starts over from the counted total, moved in place so appends go to either the old or the
+        # new one
+        write_file((str(total) + '\n').encode(), join(self.directory, self.size_name))
+        self.size_file, self.offset, self.total = None, 0, total
+
+
+# save() options accepted for every output format, with the type of their value
+ENCODER_OPTIONS = {
+    'JPEG': {'quality': int, 'progressive': bool, 'optimize': bool, 'subsampling': int},
+    'PNG': {'compress_level': int, 'optimize': bool},
+    'WEBP': {'quality': int, 'method': int, 'lossless': bool},
+}
+ENCODER_PRESETS = {
+    # fast trades size for encoding time, small the other way around. The defaults of JPEG are already its fastest
+    # settings, fast leaves them as they are
+    'fast': {'PNG': {'compress_level': 1}, 'WEBP': {'method': 0}},
+    'small': {'JPEG': {'optimize': True, 'progressive': True}, 'PNG': {'optimize': True}, 'WEBP': {'method': 6}},
+}
+
+
+def is_encoder_option(part: str) -> bool:
+    name = part.partition('=')[0].strip().lower()
+    return '=' in part or name in ENCODER_PRESETS or any(name in options for options in ENCODER_OPTIONS.values())
+
+
+def encoder_options(file_format: str, parts: list) -> dict:
+    """Turns option parts like ['quality=80', 'progressive'] or ['fast'] into the keyword arguments of save() for
+    the given format, a bare option name meaning true. Presets are applied in order with the other options"""
+    encoder = Image.registered_extensions().get('.' + file_format.lower())
+    if encoder not in ENCODER_OPTIONS:
+        raise InvalidEncoderOptionError('Encoder options are not available for ' + file_format + ' output')
+    options = {}
+    for part in parts:
+        name, _, value = part.partition('=')
+        name = name.strip().lower()
+        if name in ENCODER_PRESETS:
+            options.update(ENCODER_PRESETS[name].get(encoder, {}))
+        elif name not in ENCODER_OPTIONS[encoder]:
+            raise InvalidEncoderOptionError('Invalid option "' + part + '" for ' + file_format + ' output, '
+                                            'available options: ' + ', '.join(list(ENCODER_OPTIONS[encoder]) +
+                                                                              list(ENCODER_PRESETS)))
+        elif ENCODER_OPTIONS[encoder][name] is bool:
+            options[name] = value.strip().lower() in ['', 'true', '1', 'yes']
+        else:
+            try:
+                options[name] = int(value)
+            except ValueError:
+                raise InvalidEncoderOptionError('Invalid value for option "' + name + '": "' + value + '", please '
+                                                'provide an int number')
+    return options
+
+
+def encode_image(image: Image, path: str, options: dict = None) -> bytes:
+    extension = splitext(path)[1].lower()
+    if extension not in Image.registered_extensions():
+        raise ValueError('unknown file extension: ' + extension)
+    buffer = io.BytesIO()
+    image.save(buffer, format=Image.registered_extensions()[extension], **(options or {}))
+    return buffer.getvalue()
+
+
+# output formats keeping every frame of an animation or every page of a multi page input
+MULTI_FRAME_FORMATS = ['GIF', 'WEBP', 'PNG', 'TIFF']
+
+
+def is_multi_frame(image: Image, path: str) -> bool:
+    encoder = Image.registered_extensions().get(splitext(path)[1].lower())
+    return getattr(image, 'n_frames', 1) > 1 and encoder in MULTI_FRAME_FORMATS
+
+
+def read_frames(image: Image):
+    """Yields a copy of every frame, decoded one at a time, with its duration and disposal. Palette frames are
+    converted, the palettes of the frames of a gif do not have to be the same"""
+    for index in range(image.n_frames):
+        image.seek(index)
+        if image.mode == 'P':
+            frame = image.convert('RGBA' if has_transparency(image) else 'RGB')
+        else:
+            frame = image.copy()
+        yield frame, {'duration': image.info.get('duration'), 'disposal': getattr(image, 'disposal_method', None)}
+    image.seek(0)
+
+
+def filter_frame(frame: Image, timing: dict, options: dict) -> tuple:
+    return ImageWorker(operation=options).apply_filters(frame), timing
+
+
+def map_bounded(executor, function, arguments, window: int):
+    """Like executor.map, but submits at most window tasks ahead of the result being consumed, so neither the
+    inputs nor the results pile up in memory"""
+    pending = collections.deque()
+    for task in arguments:
+        pending.append(executor.submit(function, *task))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+class FrameValues(list):
+    """Values given to the encoder for every frame. The gif encoder merges identical frames and writes a single
+    frame when all of them are the same, reading the value as one number then, the one of the first frame"""
+
+    def __int__(self):
+        return int(self[0])
+
+
+def encode_frames(frames, path: str, options: dict = None, loop: int = None) -> bytes:
+    """Encodes the (frame, timing) pairs as they come in a multi frame file, keeping the duration of every frame,
+    the disposal and the loop count. TIFF pages are written one by one, the gif encoder only keeps its palette
+    version of the frames, webp and png need all of them before encoding"""
+    encoder = Image.registered_extensions()[splitext(path)[1].lower()]
+    frames = iter(frames)
+    first, timing = next(frames)
+    # the encoders look at the duration and disposal of a frame only once they get to it, so the lists are
+    # filled while the frames are handed to them
+    durations, disposals = [timing['duration'] or 0], FrameValues([timing['disposal'] or 0])
+
+    def following():
+        for frame, frame_timing in frames:
+            durations.append(frame_timing['duration'] or 0)
+            disposals.append(frame_timing['disposal'] or 0)
+            yield frame
+
+    buffer = io.BytesIO()
+    if encoder == 'TIFF':
+        from PIL import TiffImagePlugin
+        with TiffImagePlugin.AppendingTiffWriter(buffer) as tiff:
+            for frame in itertools.chain([first], following()):
+                frame.save(tiff, format='TIFF', **(options or {}))
+                tiff.newFrame()
+        return buffer.getvalue()
+
+    # only the gif encoder goes through the frames a single time
+    save_options = dict(options or {}, save_all=True,
+                        append_images=following() if encoder == 'GIF' else list(following()))
+    if timing['duration'] is not None:
+        save_options['duration'] = durations
+    if encoder == 'GIF' and timing['disposal'] is not None:
+        save_options['disposal'] = disposals
+    if loop is not None:
+        save_options['loop'] = loop
+    first.save(buffer, format=encoder, **save_options)
+    return buffer.getvalue()
+
+
+def write_file(data: bytes, path: str) -> int:
+    makedirs(dirname(path) or '.', exist_ok=True)
+    # written aside and moved in place, so a reader or a crash never leaves half a file
+    descriptor, temporary = tempfile.mkstemp(dir=dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'wb') as temporary_file:
+            written = temporary_file.write(data)
+        os.replace(temporary, path)
+    except BaseException:
+        os.remove(temporary)
+        raise
+    return written
+
+
+class StageProfiler:
+    """Records wall time, cpu time, memory and the image size and mode before and after every stage of processing
+    an image: decode, each filter, encode and write. Every record is handed to a callback or appended as a JSON
+    line to a file, - meaning stdout"""
+
+    def __init__(self, target, **context):
+        self.target = target
+        # added to every record, like the input and output of the image
+        self.context = context
+
+    @staticmethod
+    def describe(value, suffix: str) -> dict:
+        if isinstance(value, Image.Image):
+            return {'size_' + suffix: list(value.size), 'mode_' + suffix: value.mode}
+        if isinstance(value, bytes):
+            return {'bytes_' + suffix: len(value)}
+        return {}
+
+    def measure(self, stage: str, function, image, *arguments, **fields):
+        import tracemalloc
+        try:
+            import resource
+        except ImportError:
+            # not available on Windows, the rss peak is left out there
+            resource = None
+        record = dict(self.context, stage=stage, **fields)
+        record.update(self.describe(image, 'before'))
+
+        # numpy buffers are traced, PIL allocates image memory on its own so the rss peak is reported as well.
+        # Tracing slows down every allocation, it is only on during the stage unless someone else turned it on
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        # reset_peak() is only there from Python 3.9, before it the peak is only fresh when tracing started here
+        resettable = hasattr(tracemalloc, 'reset_peak')
+        try:
+            if resettable:
+                tracemalloc.reset_peak()
+            traced = tracemalloc.get_traced_memory()[0]
+            wall, cpu = time.perf_counter(), time.process_time()
+            result = function(image, *arguments)
+            record['wall_seconds'] = time.perf_counter() - wall
+            record['cpu_seconds'] = time.process_time() - cpu
+            record['allocated_bytes'] = tracemalloc.get_traced_memory()[1] - traced if started or resettable else None
+        finally:
+            if started:
+                tracemalloc.stop()
+        record['max_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (
+            1 if sys.platform == 'darwin' else 1024) if resource else None
+        record.update(self.describe(result, 'after'))
+
+        self.emit(record)
+        return result
+
+    def emit(self, record: dict):
+        if callable(self.target):
+            self.target(record)
+            return
+        line = (json.dumps(record) + '\n').encode()
+        if self.target == '-':
+            sys.stdout.buffer.write(line)
+            sys.stdout.flush()
+            return
+        # a single append per record keeps lines whole when several processes share the file
+        descriptor = os.open(self.target, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(descriptor, line)
+        finally:
+            os.close(descriptor)
+
+
+# rough number of bytes a pixel needs while going through the color filters, the float32 sepia buffers included
+TILE_BYTES_PER_PIXEL = 48
+
+
+# modes of color filter results PIL can build an image over a buffer for without copying it, the others are copied
+# by Image.frombuffer
+MAPPED_MODES = ['L', 'RGBA']
+
+
+def apply_tiled(image: Image, steps: list, memory_budget: int, scratch_dir: str = None, threads: int = 1) -> Image:
+    """Runs pointwise steps over horizontal strips sized to fit the memory budget, so the temporaries of the
+    filters never cover more than a strip. When PIL can map the mode of the result, every strip is written into a
+    memory mapped scratch file and the result is an image backed by that file. RGB and 1 images are stored with
+    another layout than their bytes and would be copied anyway, the strips are pasted into the result instead.
+    Since the steps are pointwise the output is byte identical to running them over the whole image. With several
+    threads the budget is shared by the strips being filtered at the same time"""
+    width, height = image.size
+    rows = max(1, min(height, memory_budget // (width * TILE_BYTES_PER_PIXEL * threads)))
+
+    # a single pixel is enough to know the mode the steps produce
+    sample = image.crop((0, 0, 1, 1))
+    for step in steps:
+        sample = step.apply(sample)
+    mode = sample.mode
+
+    if mode in MAPPED_MODES:
+        import numpy as np
+        stride = len(Image.new(mode, (width, 1)).tobytes())
+        # the file can be closed right away, the mapping keeps the scratch space alive until the image is released
+        with tempfile.TemporaryFile(dir=scratch_dir) as scratch:
+            buffer = np.memmap(scratch, dtype=np.uint8, mode='w+', shape=(height * stride,))
+        result = None
+    else:
+        result = Image.new(mode, (width, height))
+
+    def filter_strip(top: int):
+        bottom = min(top + rows, height)
+        strip = image.crop((0, top, width, bottom))
+        for step in steps:
+            strip = step.apply(strip)
+        # strips never overlap, the threads can write to the result at the same time
+        if result is None:
+            buffer[top * stride:bottom * stride] = np.frombuffer(strip.tobytes(), dtype=np.uint8)
+        else:
+            result.paste(strip, (0, top))
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(filter_strip, range(0, height, rows)))
+    return result if result is not None else Image.frombuffer(mode, (width, height), buffer, 'raw', mode, 0, 1)
+
+
+def apply_threaded(image: Image, steps: list, threads: int) -> Image:
+    """Runs pointwise steps over horizontal strips of the image on a pool of threads, PIL and NumPy release the GIL
+    while going through the pixels. Byte identical to running them over the whole image"""
+    width, height = image.size
+    bounds = strip_bounds(height, threads)
+    image.load()
+
+    def filter_strip(rows: tuple) -> Image:
+        strip = image.crop((0, rows[0], width, rows[1]))
+        for step in steps:
+            strip = step.apply(strip)
+        return strip
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        strips = list(executor.map(filter_strip, bounds))
+    result = Image.new(strips[0].mode, (width, height))
+    for (top, _), strip in zip(bounds, strips):
+        result.paste(strip, (0, top))
+    return result
+
+
+class FilterStep:
+    """A single filter of the chain, applied as it is"""
+
+    def __init__(self, name: str, parameters: list):
+        self.name = name
+        self.parameters = parameters
+
+    @property
+    def tileable(self) -> bool:
+        return self.name in ColorStep.filters
+
+    @property
+    def chain(self) -> list:
+        return [':'.join([self.name] + list(self.parameters))]
+
+    def array_native(self, size: tuple) -> bool:
+        return False
+
+    def apply(self, image: Image) -> Image:
+        return FILTERS[self.name].function(image, *self.parameters)
+
+
+class GeometricStep:
+    """Adjacent rotate, flip and resize filters composed into one affine transform. Parts of the image cropped
+    by an intermediate rotation are not lost anymore, since there is no intermediate image"""
+    filters = ['rotate', 'flip', 'resize']
+    tileable = False
+
+    def __init__(self, threads: int = 1):
+        self.parts = []
+        self.decoded = None
+        # resizes are split in strips over this many threads
+        self.threads = threads
+
+    def add(self, name: str, parameters: list):
+        self.parts.append(FilterStep(name, parameters))
+
+    @property
+    def chain(self) -> list:
+        return [fta for part in self.parts for fta in part.chain]
+
+    def transform(self, size: tuple) -> tuple:
+        """Returns the composed matrix, the output size and the quality of the last resize of the step, None when
+        there is no resize"""
+        matrix, quality = AFFINE_IDENTITY, None
+        for part in self.parts:
+            part_matrix, size = FILTERS[part.name].transform(size, *part.parameters)
+            matrix = compose_affine(matrix, part_matrix)
+            if part.name == 'resize':
+                quality = ImageWorker.resize_quality(*part.parameters[2:3])
+        return matrix, size, quality
+
+    def decode(self, image: Image) -> Image:
+        """Decodes an image that was only opened, at a reduced scale when the step shrinks it enough for that not
+        to be noticed. The transform computed for the full size is kept for when the step is applied"""
+        matrix, size, quality = self.transform(image.size)
+        image, matrix = reduce_on_decode(image, matrix)
+        image.load()
+        self.decoded = (image.size, matrix, size, quality)
+        return image
+
+    def apply(self, image: Image) -> Image:
+        if self.decoded and self.decoded[0] == image.size:
+            _, matrix, size, quality = self.decoded
+            self.decoded = None
+        elif len(self.parts) == 1 and (self.threads == 1 or self.parts[0].name != 'resize'):
+            return self.parts[0].apply(image)
+        else:
+            matrix, size, quality = self.transform(image.size)
+        # rotate alone samples with NEAREST, as soon as the image is also scaled use the filter of the resize
+        resample, reducing_gap = RESIZE_QUALITIES[quality] if quality else (Image.NEAREST, None)
+        return apply_affine(image, matrix, size, resample, self.threads, reducing_gap)
+
+    def array_native(self, size: tuple) -> bool:
+        """Flips and multiples of 90 degrees without a resize are only a different view of the same pixels"""
+        matrix, new_size, _ = self.transform(size)
+        transpose = find_transpose(matrix, size, new_size)
+        return transpose is not None and transpose[1] == new_size
+
+    def apply_array(self, pixels: 'np.ndarray') -> 'np.ndarray':
+        size = (pixels.shape[1], pixels.shape[0])
+        matrix, new_size, _ = self.transform(size)
+        method, _ = find_transpose(matrix, size, new_size)
+        return TRANSPOSE_VIEWS[method](pixels)
+
+
+class ColorStep:
+    """Adjacent gray_scale, black_and_white and sepia filters compiled into a single pass. Leading sepia filters
+    are applied together in one numpy pass, everything after the first gray_scale or black_and_white only depends
+    on the gray value of the pixel and becomes a lookup table applied with a single Image.point"""
+    filters = ['gray_scale', 'black_and_white', 'sepia']
+    tileable = True
+
+    def __init__(self):
+        self.parts = []
+        self.compiled = None
+
+    def add(self, name: str, parameters: list):
+        self.parts.append(FilterStep(name, parameters))
+
+    @property
+    def chain(self) -> list:
+        return [fta for part in self.parts for fta in part.chain]
+
+    def compile(self) -> list:
+        """Returns the parameters of every part normalized, so equivalent parameters share the same compiled
+        table, like sepia:0.60 and sepia:0.6"""
+        compiled = []
+        for part in self.parts:
+            if part.name == 'sepia':
+                compiled.append((part.name, (str(ImageWorker.sepia_ratio(*part.parameters)),)))
+            elif part.name == 'black_and_white':
+                compiled.append((part.name, (str(ImageWorker.black_and_white_threshold(*part.parameters)),)))
             else:
-                print(filter_name + ' is not implemented (yet!)')
+                compiled.append((part.name, ()))
+        return compiled
+
+    def apply(self, image: Image) -> Image:
+        if len(self.parts) == 1:
+            return self.parts[0].apply(image)
+
+        # compiled once, tiled execution applies the same step to every strip
+        if self.compiled is None:
+            self.compiled = self.compile()
+        compiled = self.compiled
+        split = len(compiled)
+        for index, (name, parameters) in enumerate(compiled):
+            if name != 'sepia':
+                split = index
+                break
+        ratios = [float(parameters[0]) for name, parameters in compiled[:split]]
+        tail = tuple(compiled[split:])
+
+        if not tail:
+            return Image.fromarray(sepia_pixels(image, ratios)) if ratios else image
+        if ratios:
+            image = Image.fromarray(sepia_pixels(image, ratios))
+        gray = image.convert('L')
+        table, mode = color_table(tail)
+        return gray.point(table, mode)
+
+    def array_native(self, size: tuple) -> bool:
+        return all(part.name == 'sepia' for part in self.parts)
+
+    def apply_array(self, pixels: 'np.ndarray') -> 'np.ndarray':
+        if self.compiled is None:
+            self.compiled = self.compile()
+        return sepia_array(pixels, [float(parameters[0]) for name, parameters in self.compiled])
+
+
+# modes of the images built from arrays, by number of bands
+ARRAY_MODES = {1: 'L', 2: 'LA', 3: 'RGB', 4: 'RGBA'}
+
+
+def array_to_image(pixels: 'np.ndarray') -> Image:
+    """Image reading the memory of the array when PIL stores the mode the same way (L and RGBA), otherwise a copy"""
+    import numpy as np
+    pixels = np.ascontiguousarray(pixels)
+    mode = ARRAY_MODES[1 if pixels.ndim == 2 else pixels.shape[2]]
+    return Image.frombuffer(mode, (pixels.shape[1], pixels.shape[0]), pixels, 'raw', mode, 0, 1)
+
+
+def image_to_array(image: Image) -> 'np.ndarray':
+    import numpy as np
+    if image.mode == '1':
+        image = image.convert('L')
+    elif image.mode not in ARRAY_MODES.values():
+        image = image.convert('RGBA' if has_transparency(image) else 'RGB')
+    return np.asarray(image)
+
+
+def filter_array(pixels, filters: list, size: tuple = None, mode: str = None) -> 'np.ndarray':
+    """Applies the filter chain to pixels in memory and returns them as a uint8 numpy array. The pixels are a
+    height x width (x bands) uint8 array, or any object with the buffer protocol shaped like one, or flat bytes
+    when size and mode (L, LA, RGB or RGBA) are given. Consecutive steps able to work on arrays keep the pixels
+    as an array, flips and rotations by 90 degrees are just views, so the result may share the memory of the
+    input. The other steps get an image sharing the memory of the array when the mode allows it. Unknown filters
+    and wrong numbers of parameters raise instead of being skipped with a message"""
+    filters = validate_chain(filters, strict=True)
+    import numpy as np
+    if size is not None:
+        if mode not in ARRAY_MODES.values():
+            raise InvalidArrayError('Invalid mode "' + str(mode) + '", please provide L, LA, RGB or RGBA')
+        bands = len(mode)
+        try:
+            pixels = np.frombuffer(pixels, dtype=np.uint8).reshape((size[1], size[0], bands)[:3 if bands > 1 else 2])
+        except ValueError as e:
+            raise InvalidArrayError(str(e) + '. The buffer does not hold ' + mode + ' pixels of the given size')
+    pixels = np.asarray(pixels)
+    if pixels.dtype != np.uint8 or not (pixels.ndim == 2 or pixels.ndim == 3 and pixels.shape[2] in ARRAY_MODES):
+        raise InvalidArrayError('Invalid pixels, please provide a uint8 array of height x width x 1 to 4 bands')
+    if pixels.ndim == 3 and pixels.shape[2] == 1:
+        pixels = pixels[..., 0]
+
+    current = pixels
+    for step in ImageWorker(operation={'filters': filters}).plan():
+        on_array = not isinstance(current, Image.Image)
+        size = (current.shape[1], current.shape[0]) if on_array else current.size
+        if step.array_native(size):
+            current = step.apply_array(current if on_array else image_to_array(current))
+        else:
+            current = step.apply(array_to_image(current) if on_array else current)
+    return image_to_array(current) if isinstance(current, Image.Image) else current
+
+
+class BackgroundWriter:
+    """Encodes and writes results on a thread of its own while the next image is filtered, PIL releases the GIL
+    while encoding. At most queue_size results wait to be written, so they do not pile up in memory when the
+    disk is slower than the filters"""
+
+    def __init__(self, queue_size: int = 2):
+        self.queue = queue.Queue(maxsize=queue_size)
+        # error messages by the key given with the task
+        self.errors = {}
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def submit(self, key, function, *arguments):
+        self.queue.put((key, function, arguments))
+
+    def work(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            key, function, arguments = task
+            try:
+                function(*arguments)
+            except Exception as e:
+                self.errors[key] = e.__class__.__name__ + ': ' + str(e)
+
+    def close(self) -> dict:
+        """Waits for everything submitted to be written and returns the errors"""
+        self.queue.put(None)
+        self.thread.join()
+        return self.errors
+
+
+def process_image_files(paths: list, filters: list, outputs: list, output_dir: str = 'results',
+                        options: dict = None) -> list:
+    """Processes several images in a row, encoding and writing every result in the background while the next
+    one is filtered. Used for the chunks of images given to every batch worker process"""
+    # the stages of two images would overlap in the profile, keep them apart when profiling
+    writer = None if (options or {}).get('profile') else BackgroundWriter()
+    reports = [process_image_file(path, filters, output, output_dir, options, writer)
+               for path, output in zip(paths, outputs)]
+    if writer:
+        errors = writer.close()
+        for report in reports:
+            if report['output'] in errors:
+                report['error'], report['output'] = errors[report['output']], None
+    return reports
+
+
+def process_image_file(path: str, filters: list, output: str, output_dir: str = 'results',
+                       options: dict = None, writer: BackgroundWriter = None) -> dict:
+    """Applies the filter chain to a single image file, used by the batch worker processes. Errors are
+    reported in the returned summary instead of raised so one bad file does not abort the whole batch"""
+    start = time.time()
+    report = {'input': path, 'output': None, 'megapixels': 0.0, 'seconds': 0.0, 'error': None}
+    try:
+        with Image.open(path) as image:
+            report['megapixels'] = image.size[0] * image.size[1] / 1e6
+            worker = ImageWorker(operation=dict(options or {}, input=image, filters=filters, output=output,
+                                                output_dir=output_dir, show=False, writer=writer))
+            report['output'] = worker.run()
+    except Exception as e:
+        report['error'] = e.__class__.__name__ + ': ' + str(e)
+    report['seconds'] = time.time() - start
+    return report
+
+
+class BatchWorker:
 
-        result_image.show()
-        if not exists('results'):
-            mkdir('results')
-        result_image.save('results/' + self.output)
+    def __init__(self, operation: dict):
+        self.inputs = operation.get('inputs', [])
+        self.filters_to_apply = operation.get('filters', [])
+        self.output = operation.get('output')
+        self.output_dir = operation.get('output_dir', 'results')
+        self.jobs = operation.get('jobs') or cpu_count() or 1
+        # options forwarded as they are to the ImageWorker of every image
+        self.options = {key: operation[key] for key in ['memory_budget', 'scratch_dir', 'profile', 'cache',
+                                                        'encoder', 'threads'] if key in operation}
+
+    def get_filters_to_apply(self):
+        # the chain is checked once for the whole batch instead of once per image
+        return validate_chain(self.filters_to_apply)
+
+    def get_output_names(self):
+        # the output name becomes the folder for the batch, every result keeps the name of its input
+        folder, file_format = splitext(self.output)
+        names, used = [], collections.Counter()
+        for path in self.inputs:
+            stem = splitext(basename(path))[0]
+            used[stem] += 1
+            if used[stem] > 1:
+                stem += '_' + str(used[stem] - 1)
+            names.append(join(folder, stem + file_format))
+        return names
+
+    def run(self):
+        if not self.inputs:
+            raise InvalidPILImageCreatedError('No images were found for the given input.')
+
+        filters = self.get_filters_to_apply()
+        outputs = self.get_output_names()
+        # every process gets chunks of images, so it can write one result while it filters the next
+        chunk_size = max(1, min(32, len(outputs) // (self.jobs * 4)))
+        chunks = range(0, len(outputs), chunk_size)
+        arguments = ([self.inputs[index:index + chunk_size] for index in chunks], [filters] * len(chunks),
+                     [outputs[index:index + chunk_size] for index in chunks], [self.output_dir] * len(chunks),
+                     [self.options] * len(chunks))
+
+        start = time.time()
+        if self.jobs == 1:
+            reports = self.report(itertools.chain.from_iterable(map(process_image_files, *arguments)))
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+                reports = self.report(itertools.chain.from_iterable(executor.map(process_image_files, *arguments)))
+        elapsed = time.time() - start
+
+        failed = [report for report in reports if report['error']]
+        megapixels = sum(report['megapixels'] for report in reports if not report['error'])
+        print('Processed ' + str(len(reports) - len(failed)) + ' of ' + str(len(reports)) + ' images in ' +
+              '%.2f' % elapsed + 's (' + '%.2f' % (len(reports) / elapsed if elapsed else 0) + ' images/s, ' +
+              '%.2f' % (megapixels / elapsed if elapsed else 0) + ' MP/s), ' + str(len(failed)) + ' failed.')
+        return reports
+
+    @staticmethod
+    def report(reports) -> list:
+        finished = []
+        for report in reports:
+            if report['error']:
+                print('Failed ' + report['input'] + ': ' + report['error'])
+            finished.append(report)
+        return finished
+
+
+class WatchWorker:
+    """Keeps processing the images dropped into a directory. An index next to the results records the size,
+    modification time and digest of every input and the chain it went through, so only new or changed images are
+    processed, also after a restart. Every image is added to the index as soon as its result is written, a crash
+    only redoes the images that were in progress"""
+
+    index_name = '.filter_index.jsonl'
+
+    def __init__(self, operation: dict):
+        self.directory = abspath(operation['watch_dir'])
+        self.interval = operation.get('watch', 2.0)
+        self.filters_to_apply = validate_chain(operation.get('filters', []))
+        self.folder, self.file_format = splitext(operation.get('output'))
+        self.output_dir = operation.get('output_dir', 'results')
+        self.jobs = operation.get('jobs') or cpu_count() or 1
+        self.options = {key: operation[key] for key in ['memory_budget', 'scratch_dir', 'profile', 'cache',
+                                                        'encoder', 'threads'] if key in operation}
+        # changing the filters or how results are encoded processes every image again
+        self.chain = ResultCache.key(self.file_format.lower(), json.dumps(self.options.get('encoder') or {},
+                                                                          sort_keys=True),
+                                     *[normalize_filter(fta) for fta in self.filters_to_apply])
+        self.index_path = join(self.output_dir, self.folder, self.index_name)
+        self.index = self.load_index()
+        self.owners = {entry['output']: path for path, entry in self.index.items()}
+        # size and modification time of every image in the previous scan, and of the ones that failed
+        self.seen = {}
+        self.failed = {}
+
+    def load_index(self) -> dict:
+        index = {}
+        if isfile(self.index_path):
+            with open(self.index_path) as index_file:
+                for line in index_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line is cut short when the process dies while writing it
+                        continue
+                    index[entry['path']] = entry
+        # compacted to the last entry of every input still there, the appends of this run follow
+        index = {path: entry for path, entry in index.items() if isfile(path)}
+        write_file(''.join(json.dumps(entry, sort_keys=True) + '\n' for entry in index.values()).encode(),
+                   self.index_path)
+        return index
+
+    def record(self, entry: dict):
+        self.index[entry['path']] = entry
+        with open(self.index_path, 'a') as index_file:
+            index_file.write(json.dumps(entry, sort_keys=True) + '\n')
+            index_file.flush()
+            os.fsync(index_file.fileno())
+
+    def get_output_name(self, path: str) -> str:
+        if path in self.index:
+            # a changed image replaces its previous result
+            return splitext(self.index[path]['output'])[0] + self.file_format
+        stem = splitext(basename(path))[0]
+        output, number = join(self.folder, stem + self.file_format), 0
+        while self.owners.get(output, path) != path:
+            number += 1
+            output = join(self.folder, stem + '_' + str(number) + self.file_format)
+        self.owners[output] = path
+        return output
+
+    def scan(self) -> list:
+        """Returns the size and modification time of the images that are new or changed since they were processed
+        and are not being written anymore"""
+        due, seen, now = [], {}, time.time()
+        extensions = Image.registered_extensions()
+        for name in sorted(listdir(self.directory)):
+            path = join(self.directory, name)
+            if splitext(name)[1].lower() not in extensions or not isfile(path):
+                continue
+            info = stat(path)
+            state = (info.st_size, info.st_mtime_ns)
+            seen[path] = state
+            entry = self.index.get(path)
+            if entry and (entry['size'], entry['mtime']) == state and entry['chain'] == self.chain:
+                continue
+            if self.failed.get(path) == state:
+                continue
+            # still being copied into the directory, it is left for a later scan
+            if self.seen.get(path) != state and now - info.st_mtime < self.interval:
+                continue
+            due.append((path, state))
+        self.seen = seen
+        return due
+
+    def process(self, due: list, executor: 'ProcessPoolExecutor' = None) -> list:
+        pending = []
+        for path, (size, mtime) in due:
+            try:
+                digest = file_digest(path)
+            except OSError:
+                # removed since the scan
+                continue
+            entry = {'path': path, 'size': size, 'mtime': mtime, 'digest': digest, 'chain': self.chain}
+            previous = self.index.get(path)
+            if previous and previous['digest'] == digest and previous['chain'] == self.chain:
+                # touched or copied again without changes, the result is still the right one
+                self.record(dict(previous, size=size, mtime=mtime))
+                continue
+            pending.append(dict(entry, output=self.get_output_name(path)))
+
+        # one task per image written without a background writer, so every result is on disk when its report
+        # comes back and it is added to the index right away
+        arguments = [(entry['path'], self.filters_to_apply, entry['output'], self.output_dir, self.options)
+                     for entry in pending]
+        if executor:
+            from concurrent.futures import as_completed
+            futures = {executor.submit(process_image_file, *image_arguments): entry
+                       for entry, image_arguments in zip(pending, arguments)}
+            finished = ((future.result(), futures[future]) for future in as_completed(futures))
+        else:
+            finished = ((process_image_file(*image_arguments), entry)
+                        for entry, image_arguments in zip(pending, arguments))
+
+        reports = []
+        for report, entry in finished:
+            if report['error']:
+                print('Failed ' + report['input'] + ': ' + report['error'])
+                self.failed[entry['path']] = (entry['size'], entry['mtime'])
+            else:
+                self.record(entry)
+            reports.append(report)
+        return reports
+
+    def run(self, cycles: int = None):
+        """Scans the directory every interval seconds until interrupted, or the given number of times"""
+        print('Watching ' + self.directory + ', results are saved in ' + join(self.output_dir, self.folder))
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=self.jobs) if self.jobs > 1 else None
+        cycle = 0
+        try:
+            while cycles is None or cycle < cycles:
+                start = time.time()
+                reports = self.process(self.scan(), executor)
+                if reports:
+                    failed = len([report for report in reports if report['error']])
+                    print('Processed ' + str(len(reports) - failed) + ' of ' + str(len(reports)) +
+                          ' new or changed images in ' + '%.2f' % (time.time() - start) + 's, ' + str(failed) +
+                          ' failed.')
+                cycle += 1
+                if cycles is None or cycle < cycles:
+                    time.sleep(self.interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if executor:
+                executor.shutdown()
+
+
+class FrameReader:
+    """Reads the images of a stream one at a time: concatenated PNG, PPM or PGM images, or raw frames of a given
+    width, height and mode. Pixels are read into the same buffer for every frame of the same size, so memory does
+    not grow with the length of the stream"""
+
+    def __init__(self, stream, raw: tuple = None):
+        self.stream = stream
+        self.raw = raw
+        self.buffer = bytearray()
+
+    def __iter__(self):
+        while True:
+            frame = self.read()
+            if frame is None:
+                return
+            yield frame
+
+    def read_exactly(self, size: int) -> bytes:
+        data = self.stream.read(size)
+        while data and len(data) < size:
+            more = self.stream.read(size - len(data))
+            if not more:
+                break
+            data += more
+        if data and len(data) < size:
+            raise InvalidStreamError('The stream ended in the middle of an image')
+        return data
+
+    def read(self):
+        if self.raw:
+            return self.read_pixels(*self.raw, first=True)
+        magic = self.read_exactly(2)
+        if not magic:
+            return None
+        if magic == b'\x89P':
+            return self.read_png(magic)
+        if magic in [b'P5', b'P6']:
+            return self.read_netpbm(magic)
+        raise InvalidStreamError('Unknown image in the stream, only PNG, PPM and PGM images are read, or raw frames '
+                                 'with the -r flag')
+
+    def read_pixels(self, width: int, height: int, mode: str, first: bool = False):
+        size = width * height * len(mode)
+        if len(self.buffer) != size:
+            self.buffer = bytearray(size)
+        view, read = memoryview(self.buffer), 0
+        while read < size:
+            count = self.stream.readinto(view[read:])
+            if not count:
+                if first and not read:
+                    return None
+                raise InvalidStreamError('The stream ended in the middle of an image')
+            read += count
+        # the image reads the buffer directly when PIL stores the mode the same way, it is filtered before the
+        # buffer is used again
+        return Image.frombuffer(mode, (width, height), self.buffer, 'raw', mode, 0, 1)
+
+    def read_netpbm(self, magic: bytes) -> Image:
+        # width, height and maximum value, separated by whitespace and comments, then a single whitespace
+        fields, field = [], b''
+        while len(fields) < 3:
+            character = self.read_exactly(1)
+            if not character:
+                raise InvalidStreamError('The stream ended in the middle of an image')
+            if character == b'#':
+                while character not in [b'\n', b'']:
+                    character = self.stream.read(1)
+            elif character.isspace():
+                if field:
+                    fields.append(field)
+                    field = b''
+            else:
+                field += character
+        try:
+            width, height, maximum = [int(value) for value in fields]
+        except ValueError:
+            raise InvalidStreamError('Invalid PPM header in the stream')
+        if maximum > 255:
+            raise InvalidStreamError('Only 8 bit PPM and PGM images are read from the stream')
+        return self.read_pixels(width, height, 'L' if magic == b'P5' else 'RGB')
+
+    def read_png(self, magic: bytes) -> Image:
+        data = io.BytesIO()
+        data.write(magic + self.read_exactly(6))
+        # chunks are a length, a type, the data and a crc, until the IEND chunk
+        while True:
+            header = self.read_exactly(8)
+            if len(header) < 8:
+                raise InvalidStreamError('The stream ended in the middle of an image')
+            data.write(header)
+            data.write(self.read_exactly(int.from_bytes(header[:4], 'big') + 4))
+            if header[4:] == b'IEND':
+                break
+        image = Image.open(data)
+        image.load()
+        return image
+
+
+def encode_frame(image: Image, file_format: str, options: dict = None) -> bytes:
+    """Encodes a streamed result, ppm and raw frames keep to the modes readers of those expect"""
+    if file_format == 'raw':
+        return image.convert('RGB' if image.mode == 'P' else 'L').tobytes() if image.mode in ['1', 'P'] \
+            else image.tobytes()
+    if file_format == 'ppm' and image.mode not in ['L', 'RGB']:
+        image = image.convert('L' if image.mode in ['1', 'LA'] else 'RGB')
+    return encode_image(image, 'frame.' + file_format, options)
+
+
+def filter_stream(source, target, filters: list, file_format: str = 'ppm', raw: tuple = None,
+                  encoder: dict = None, options: dict = None) -> int:
+    """Applies the chain to every image read from source, writing every result to target as soon as it is
+    ready. The chain is planned once for the whole stream. Returns the number of frames"""
+    # messages would end up mixed with the images in the output, a bad chain is an error here
+    filters = validate_chain(filters, strict=True)
+    worker = ImageWorker(operation=dict(options or {}, filters=filters))
+    steps = worker.plan()
+    count = 0
+    for frame in FrameReader(source, raw):
+        target.write(encode_frame(worker.apply_filters(frame, steps), file_format, encoder))
+        target.flush()
+        count += 1
+    return count
+
+
+def process_image_bytes(data: bytes, filters: list, file_format: str = 'png', options: dict = None,
+                        encoder: list = None) -> bytes:
+    """Applies the filter chain to an encoded image kept in memory and returns the encoded result, nothing is
+    written to disk. Encoder options are given like on the -o flag, ['quality=80', 'progressive']. Used by the
+    server mode"""
+    filters = validate_chain(filters, strict=True)
+    if file_format not in InputParser.accepted_output_formats:
+        raise InvalidOutputFileExtensionProvidedError('Invalid output file extension error: provided extension '
+                                                      'not acceptable, provide one of ' +
+                                                      ', '.join(InputParser.accepted_output_formats))
+    encoder_settings = encoder_options(file_format, encoder) if encoder else {}
+
+    with Image.open(io.BytesIO(data)) as image:
+        worker = ImageWorker(operation=dict(options or {}, input=image, filters=filters, show=False))
+        result_image = worker.apply_filters(image)
+        return encode_image(result_image, 'result.' + file_format, encoder_settings)
 
 
 if __name__ == '__main__':
     parser = InputParser(untreated_arguments=sys.argv[1:])
-    ImageWorker(operation=parser.requested_operation).run()
+    if 'serve' in parser.requested_operation:
+        # the server and its http modules are only imported when asked for
+        from filter_server import serve
+        serve(parser.requested_operation)
+    elif 'stream' in parser.requested_operation:
+        operation = parser.requested_operation
+        try:
+            filter_stream(sys.stdin.buffer, sys.stdout.buffer, operation['filters'], operation['stream_format'],
+                          operation['raw'], operation['encoder'],
+                          {key: operation[key] for key in ['threads', 'memory_budget'] if operation[key]})
+        except BrokenPipeError:
+            # whoever reads the results went away, like head does, there is nobody left to tell
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    elif 'watch' in parser.requested_operation:
+        WatchWorker(operation=parser.requested_operation).run()
+    elif 'inputs' in parser.requested_operation:
+        BatchWorker(operation=parser.requested_operation).run()
+    else:
+        # a single image uses the processes for its frames, when it has more than one
+        ImageWorker(operation=dict(parser.requested_operation,
+                                   jobs=parser.requested_operation['jobs'] or cpu_count())).run()
@@ -0,0 +1,118 @@
+# coding: utf-8
+
+"""Server mode of filter_image.py, kept apart so running a filter from the command line does not import the http
+modules"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import cpu_count
+from urllib.parse import urlparse, parse_qs
+
+from PIL import Image
+
+from filter_image import (process_image_bytes, FilterNotImplementedError, FilterNotAllowedError,
+                          InvalidNumberOfArgumentsError, InvalidOutputFileExtensionProvidedError,
+                          InvalidFlipDirectionError, InvalidEncoderOptionError)
+
+
+class FilterRequestHandler(BaseHTTPRequestHandler):
+    """POST / with the encoded image as body and the chain in the query, ?f=resize:800&f=sepia&format=jpg&o=fast,
+    answers with the encoded result. GET /health answers ok while the server is up"""
+    protocol_version = 'HTTP/1.1'
+    # filters opening paths given in the query, any client could read files of the server through them
+    disallowed_filters = ['overlay']
+    # errors raised by bad requests, anything else is a failure of the server
+    client_errors = (FilterNotImplementedError, FilterNotAllowedError, InvalidNumberOfArgumentsError,
+                     InvalidOutputFileExtensionProvidedError, InvalidFlipDirectionError, InvalidEncoderOptionError,
+                     ValueError, OSError)
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/health':
+            self.respond(200, b'ok', 'text/plain')
+        else:
+            self.respond(404, b'Not found', 'text/plain')
+
+    def do_POST(self):
+        query = parse_qs(urlparse(self.path).query)
+        filters = query.get('f', []) + query.get('filter', [])
+        file_format = query.get('format', ['png'])[0].lower()
+        encoder = query.get('o', [])
+
+        disallowed = [fta for fta in filters if fta.split(':')[0].strip() in self.disallowed_filters]
+        if disallowed:
+            return self.refuse(400, ('FilterNotAllowedError: ' + disallowed[0].split(':')[0].strip() +
+                                     ' is not available in server mode').encode())
+        try:
+            length = int(self.headers.get('Content-Length', ''))
+        except ValueError:
+            return self.refuse(411, b'Content-Length required')
+        if length < 0:
+            return self.refuse(400, b'Invalid Content-Length')
+        if length > self.server.max_bytes:
+            return self.refuse(413, b'Image too large')
+
+        # backpressure, when every worker is busy and the queue is full the client is told to come back later
+        # before its image is read, so waiting and refused requests do not pile up in memory
+        if not self.server.slots.acquire(blocking=False):
+            return self.refuse(503, b'Busy, try again later', {'Retry-After': '1'})
+        try:
+            data = self.rfile.read(length)
+            result = self.server.executor.submit(process_image_bytes, data, filters, file_format,
+                                                 self.server.options, encoder).result()
+        except self.client_errors as e:
+            return self.respond(400, (e.__class__.__name__ + ': ' + str(e)).encode(), 'text/plain')
+        except Exception as e:
+            return self.respond(500, (e.__class__.__name__ + ': ' + str(e)).encode(), 'text/plain')
+        finally:
+            self.server.slots.release()
+        self.respond(200, result, Image.MIME[Image.registered_extensions()['.' + file_format]])
+
+    def refuse(self, status: int, body: bytes, headers: dict = None):
+        """Answers without reading the body of the request, the connection is closed since the unread body is
+        still in it"""
+        self.close_connection = True
+        self.respond(status, body, 'text/plain', dict(headers or {}, Connection='close'))
+
+    def respond(self, status: int, body: bytes, content_type: str, headers: dict = None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class FilterServer(ThreadingHTTPServer):
+    """Keeps the process warm between requests. Images are processed by a pool of jobs threads, PIL and NumPy
+    release the GIL while working on pixels, and at most queue_size more requests wait for a free thread"""
+    daemon_threads = True
+    max_bytes = 256 * 1024 * 1024
+
+    def __init__(self, address: tuple, jobs: int = None, queue_size: int = None, options: dict = None,
+                 verbose: bool = False):
+        super().__init__(address, FilterRequestHandler)
+        jobs = jobs or cpu_count() or 1
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        self.slots = threading.BoundedSemaphore(jobs + (jobs if queue_size is None else queue_size))
+        self.options = options or {}
+        self.verbose = verbose
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
+
+def serve(operation: dict):
+    options = {key: operation[key] for key in ['memory_budget', 'scratch_dir', 'threads'] if operation.get(key)}
+    with FilterServer(operation['serve'], operation.get('jobs'), options=options, verbose=True) as server:
+        print('Serving on http://' + server.server_address[0] + ':' + str(server.server_address[1]))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
@@ -1,9 +1,35 @@
 # coding: utf-8
 
+import io
+import os
+import pickle
+import socket
+import subprocess
+import sys
+import threading
+import tracemalloc
+import types
 import unittest
+import unittest.mock
+import urllib.error
+import urllib.request
+import json
+import tempfile
+from os.path import join, exists, basename
 from PIL import Image
-from filter_image import (ImageWorker, InvalidFlipDirectionError, InvalidOverlayCoordinatesError)
+from filter_image import (ImageWorker, BatchWorker, InputParser, FilterStep, GeometricStep, ColorStep, color_table,
+                          overlay_layer, InvalidFlipDirectionError, InvalidOverlayCoordinatesError,
+                          InvalidNumberOfJobsError, InvalidMemoryBudgetError, InvalidCacheSizeError,
+                          ImageWithoutTransparencyError, ResultCache, InvalidServerAddressError,
+                          FilterNotImplementedError, InvalidNumberOfArgumentsError, validate_chain, filter_array,
+                          array_to_image, InvalidArrayError, TRANSPOSE_VIEWS, InvalidEncoderOptionError,
+                          BackgroundWriter, encoder_options, write_file, InvalidNumberOfThreadsError, FrameReader,
+                          filter_stream, InvalidStreamError, InvalidRawFormatError, WatchWorker, InvalidWatchError,
+                          RESIZE_QUALITIES, apply_tiled, StageProfiler, process_image_file)
 import numpy as np
+import benchmark
+import filter_image
+from filter_server import FilterServer
 
 
 class ImageFilterTests(unittest.TestCase):
@@ -74,6 +100,48 @@ class ImageFilterTests(unittest.TestCase):
         self.assertEqual(result.size, (200, 300))
         self.assertIsInstance(result, Image.Image, "Should result in PIL Image type")
 
+    def test_resize_qualities(self):
+        img = self.worker.original_image
+        self.assertEqual(self.worker.resize(img, '200', quality='nearest').tobytes(),
+                         img.resize((200, 133), Image.NEAREST).tobytes())
+        self.assertEqual(self.worker.resize(img, '200', quality='balanced').tobytes(),
+                         img.resize((200, 133), Image.LANCZOS, reducing_gap=2.0).tobytes())
+        self.assertEqual(self.worker.resize(img, '200').tobytes(), img.resize((200, 133), Image.LANCZOS).tobytes())
+        # PIL drops the reducing gap for images with transparency, it is still used here
+        rgba = img.convert('RGBA')
+        result = self.worker.resize(rgba, '200', quality='balanced')
+        self.assertEqual(result.mode, 'RGBA')
+        self.assertNotEqual(result.tobytes(), self.worker.resize(rgba, '200').tobytes())
+        for quality in RESIZE_QUALITIES:
+            # fused with other geometric filters and split in strips the same filter is used
+            result = ImageWorker(operation={'filters': ['flip:h', 'resize:200::' + quality]}).apply_filters(img)
+            expected = self.worker.resize(img, '200', quality=quality).transpose(Image.FLIP_LEFT_RIGHT)
+            self.assertEqual(result.tobytes(), expected.tobytes(), quality)
+            # strips only differ by rounding, nearest and balanced are not split at all
+            single = self.worker.resize(img, '200', quality=quality)
+            for threads in [2, 4]:
+                result = ImageWorker(operation={'filters': ['resize:200::' + quality],
+                                                'threads': threads}).apply_filters(img)
+                difference = np.abs(np.asarray(result, dtype=int) - np.asarray(single, dtype=int))
+                self.assertLessEqual(difference.max(), 0 if quality in ['nearest', 'balanced'] else 1, quality)
+
+    def test_resize_fit(self):
+        img = self.worker.original_image
+        self.assertEqual(self.worker.resize(img, '300', '300', mode='fit').size, (300, 200))
+        self.assertEqual(self.worker.resize(img, '900', '100', mode='fit').size, (150, 100))
+        self.assertEqual(self.worker.resize(img, '300', '300', mode='stretch').size, (300, 300))
+        result = ImageWorker(operation={'filters': ['rotate:90:true', 'resize:300:300:fast:fit']}).apply_filters(img)
+        self.assertEqual(result.size, (200, 300))
+
+    def test_resize_with_invalid_quality_or_mode(self):
+        img = self.worker.original_image
+        with self.assertRaises(ValueError):
+            self.worker.resize(img, '200', quality='ugly')
+        with self.assertRaises(ValueError):
+            self.worker.resize(img, '200', '100', mode='crop')
+        with self.assertRaises(ValueError):
+            validate_chain(['resize:200::quick'])
+
     def test_resize_with_invalid_input(self):
         img = self.worker.original_image
         with self.assertRaises(ValueError):
@@ -85,6 +153,40 @@ class ImageFilterTests(unittest.TestCase):
         # there is no easy way to test if output is in sepia
         self.assertIsInstance(result, Image.Image, "Should result in PIL Image type")
 
+    def test_sepia_matches_row_by_row_implementation(self):
+        img = self.worker.original_image
+
+        def reference_sepia(image, r):
+            # the original row by row matrix product, kept here to guarantee the vectorized one is equivalent
+            matrix = [[0.393 + 0.607 * (1 - r), 0.769 - 0.769 * (1 - r), 0.189 - 0.189 * (1 - r)],
+                      [0.349 - 0.349 * (1 - r), 0.686 + 0.314 * (1 - r), 0.168 - 0.168 * (1 - r)],
+                      [0.272 - 0.349 * (1 - r), 0.534 - 0.534 * (1 - r), 0.131 + 0.869 * (1 - r)]]
+            s_map = np.array(matrix)
+            filtered = np.array([x.dot(s_map.T) for x in np.array(image)])
+            filtered[np.where(filtered > 255)] = 255
+            return filtered.astype('uint8')
+
+        for ratio in ['1', '0.75', '0.5', '0.25']:
+            expected = reference_sepia(img, float(ratio)).astype(int)
+            result = np.asarray(self.worker.sepia(image=img, ratio=ratio)).astype(int)
+            self.assertEqual(result.shape, expected.shape)
+            # float32 instead of float64 may only move a value sitting right at an integer boundary
+            self.assertLessEqual(np.abs(result - expected).max(), 1)
+            self.assertLess(np.count_nonzero(result != expected), result.size * 0.001)
+
+    def test_sepia_modes(self):
+        img = self.worker.original_image
+        self.assertEqual(self.worker.sepia(image=img.convert('L')).mode, 'RGB')
+        self.assertEqual(self.worker.sepia(image=img.convert('P')).mode, 'RGB')
+
+        rgba = img.convert('RGBA')
+        rgba.putalpha(128)
+        result = self.worker.sepia(image=rgba)
+        self.assertEqual(result.mode, 'RGBA')
+        self.assertEqual(result.getchannel('A').getextrema(), (128, 128), "Should keep the original transparency")
+        self.assertTrue(np.array_equal(np.asarray(result.convert('RGB')),
+                                       np.asarray(self.worker.sepia(image=img))))
+
     def test_sepia_invalid_ratio(self):
         img = self.worker.original_image
         with self.assertRaises(ValueError):
@@ -142,5 +244,849 @@ class ImageFilterTests(unittest.TestCase):
             self.worker.overlay(image=img, foreground_path=overlay_path, coordinates=[1, 45])
 
 
+    def test_overlay_matches_full_frame_composite(self):
+        img = self.worker.original_image
+        overlay_path = 'python.png'
+
+        def reference_overlay(image, coords):
+            # the original implementation, compositing a layer as big as the whole image
+            foreground = Image.open(overlay_path)
+            fg_image_trans = Image.new('RGBA', image.size)
+            fg_image_trans.paste(foreground, coords, mask=foreground.convert('RGBA'))
+            return Image.alpha_composite(image.convert('RGBA'), fg_image_trans).convert('RGB')
+
+        for coordinates, coords in [(None, [0, 0]), ("10,200", [10, 200]), ("-50,-20", [-50, -20]),
+                                    ("5000,5000", [img.size[0] - 360, img.size[1] - 180])]:
+            for image in [img, img.convert('L'), img.convert('RGBA')]:
+                result = self.worker.overlay(image=image, foreground_path=overlay_path, coordinates=coordinates)
+                self.assertEqual(result.mode, 'RGB')
+                self.assertTrue(np.array_equal(np.asarray(result), np.asarray(reference_overlay(image, coords))))
+
+    def test_overlay_foreground_is_cached(self):
+        img = self.worker.original_image
+        with tempfile.TemporaryDirectory() as directory:
+            overlay_path = join(directory, 'logo.png')
+            Image.open('python.png').save(overlay_path)
+            first = self.worker.overlay(image=img, foreground_path=overlay_path)
+            misses = overlay_layer.cache_info().misses
+            self.worker.overlay(image=img, foreground_path=overlay_path, coordinates="100,100")
+            self.assertEqual(overlay_layer.cache_info().misses, misses)
+
+            # a changed file is decoded again
+            Image.open('python.png').transpose(Image.FLIP_LEFT_RIGHT).save(overlay_path)
+            second = self.worker.overlay(image=img, foreground_path=overlay_path)
+            self.assertEqual(overlay_layer.cache_info().misses, misses + 1)
+            self.assertFalse(np.array_equal(np.asarray(first), np.asarray(second)))
+
+            img.save(join(directory, 'opaque.png'))
+            with self.assertRaises(ImageWithoutTransparencyError):
+                self.worker.overlay(image=img, foreground_path=join(directory, 'opaque.png'))
+
+
+class PlannerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.image = Image.open('input.jpg').resize((150, 100))
+
+    @staticmethod
+    def apply_one_by_one(image, filters):
+        for fta in filters:
+            fields = fta.split(':')
+            image = getattr(ImageWorker, fields[0])(image, *fields[1:])
+        return image
+
+    def test_plan_groups_adjacent_geometric_filters(self):
+        worker = ImageWorker(operation={'filters': ['rotate:30', 'flip:h', 'overlay:python.png', 'resize:50', 'flip:v',
+                                                    'sepia', 'gray_scale']})
+        steps = worker.plan()
+        self.assertEqual([step.__class__ for step in steps], [GeometricStep, FilterStep, GeometricStep, ColorStep])
+        self.assertEqual([part.name for part in steps[0].parts], ['rotate', 'flip'])
+        self.assertEqual([part.name for part in steps[2].parts], ['resize', 'flip'])
+
+    def test_exact_geometric_chains(self):
+        for filters in [['flip:h', 'flip:v'], ['resize:80', 'flip:h'], ['flip:v', 'resize:300'],
+                        ['rotate:30', 'flip:h'], ['rotate:90:true', 'flip:v', 'rotate:180']]:
+            worker = ImageWorker(operation={'filters': filters})
+            result = worker.apply_filters(self.image)
+            expected = self.apply_one_by_one(self.image, filters)
+            self.assertEqual(result.size, expected.size)
+            self.assertTrue(np.array_equal(np.asarray(result), np.asarray(expected)), filters)
+
+    def test_resampling_chains(self):
+        for filters in [['rotate:90:true', 'resize:50'], ['resize:200', 'resize:75'], ['rotate:30', 'resize:40']]:
+            result = ImageWorker(operation={'filters': filters}).apply_filters(self.image)
+            self.assertEqual(result.size, self.apply_one_by_one(self.image, filters).size)
+            self.assertEqual(result.mode, self.image.mode)
+
+    def test_fused_rotations_do_not_crop(self):
+        result = ImageWorker(operation={'filters': ['rotate:90', 'rotate:-90']}).apply_filters(self.image)
+        self.assertTrue(np.array_equal(np.asarray(result), np.asarray(self.image)))
+
+    def test_compiled_color_chains(self):
+        for filters in [['sepia:0.6', 'black_and_white:120'], ['sepia', 'sepia:0.3'], ['gray_scale', 'sepia:0'],
+                        ['black_and_white', 'gray_scale', 'sepia:0.5'], ['sepia:0.2', 'gray_scale', 'black_and_white'],
+                        ['gray_scale', 'black_and_white:300']]:
+            for image in [self.image, self.image.convert('L'), self.image.convert('RGBA')]:
+                worker = ImageWorker(operation={'filters': filters})
+                result = worker.apply_filters(image)
+                expected = self.apply_one_by_one(image, filters)
+                self.assertEqual(result.mode, expected.mode, filters)
+                self.assertTrue(np.array_equal(np.asarray(result), np.asarray(expected)), filters)
+
+    def test_compiled_color_tables_are_reused(self):
+        worker = ImageWorker(operation={'filters': ['sepia', 'gray_scale', 'black_and_white:0120']})
+        worker.apply_filters(self.image)
+        hits = color_table.cache_info().hits
+        worker = ImageWorker(operation={'filters': ['sepia', 'gray_scale', 'black_and_white:120']})
+        worker.apply_filters(self.image)
+        self.assertEqual(color_table.cache_info().hits, hits + 1)
+
+    def test_tiled_execution_is_byte_identical(self):
+        image = Image.open('input.jpg').crop((0, 0, 301, 203))
+        for filters in [['sepia:0.6', 'black_and_white:120'], ['sepia', 'rotate:30', 'gray_scale'],
+                        ['black_and_white', 'flip:h', 'sepia:0.3'], ['overlay:python.png', 'sepia']]:
+            expected = ImageWorker(operation={'filters': filters}).apply_filters(image)
+            # a budget this small forces strips of a couple of rows
+            result = ImageWorker(operation={'filters': filters, 'memory_budget': 301 * 48 * 2}).apply_filters(image)
+            self.assertEqual(result.mode, expected.mode, filters)
+            self.assertEqual(result.size, expected.size, filters)
+            self.assertEqual(result.tobytes(), expected.tobytes(), filters)
+
+        # only the modes PIL maps are backed by the scratch file, RGB would be copied out of it anyway
+        for mode, mapped in [('RGBA', True), ('L', True), ('RGB', False)]:
+            result = apply_tiled(image.convert(mode), [FilterStep('gray_scale', [])] if mode == 'L'
+                                 else [FilterStep('sepia', [])], 301 * 48 * 2)
+            self.assertEqual(bool(result.readonly), mapped, mode)
+
+    def test_threaded_execution(self):
+        image = Image.open('input.jpg').crop((0, 0, 301, 403))
+        for filters in [['sepia:0.6', 'black_and_white:120'], ['sepia', 'rotate:30', 'gray_scale'],
+                        ['gray_scale', 'flip:h', 'sepia:0.3']]:
+            expected = ImageWorker(operation={'filters': filters}).apply_filters(image)
+            for operation in [{'threads': 4}, {'threads': 3, 'memory_budget': 301 * 48 * 6}]:
+                result = ImageWorker(operation=dict(operation, filters=filters)).apply_filters(image)
+                self.assertEqual((result.mode, result.size), (expected.mode, expected.size), filters)
+                self.assertEqual(result.tobytes(), expected.tobytes(), filters)
+
+        # strips are resized from the rows around them, only rounding can tell them from a single resize
+        for filters in [['resize:150'], ['flip:v', 'resize:500:700']]:
+            expected = ImageWorker(operation={'filters': filters}).apply_filters(image)
+            result = ImageWorker(operation={'filters': filters, 'threads': 4}).apply_filters(image)
+            self.assertEqual(result.size, expected.size)
+            difference = np.abs(np.asarray(result, dtype=int) - np.asarray(expected, dtype=int))
+            self.assertLessEqual(difference.max(), 1, filters)
+
+        self.assertEqual(InputParser(['-i', 'input.jpg', '--threads', '4']).requested_operation['threads'], 4)
+        with self.assertRaises(InvalidNumberOfThreadsError):
+            InputParser(['-i', 'input.jpg', '-t', '0'])
+
+    def test_reduced_decode_when_chain_starts_with_downscale(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ['big.jpg', 'big.png']:
+                path = join(directory, name)
+                Image.open('input.jpg').resize((2400, 1600)).save(path)
+                for filters in [['resize:200'], ['flip:h', 'resize:150:100'], ['rotate:90:true', 'resize:100']]:
+                    exact = ImageWorker(operation={'filters': filters, 'reduced_decode': False})
+                    expected = exact.apply_filters(Image.open(path))
+
+                    image = Image.open(path)
+                    result = ImageWorker(operation={'filters': filters}).apply_filters(image)
+                    if name.endswith('.jpg'):
+                        self.assertLess(image.size[0], 2400, "Should decode the jpeg at a reduced scale")
+                    self.assertEqual(result.size, expected.size)
+                    difference = np.asarray(result).astype(float) - np.asarray(expected)
+                    psnr = 10 * np.log10(255 ** 2 / np.mean(difference ** 2))
+                    self.assertGreater(psnr, 35, filters)
+
+    def test_decoded_images_are_not_reduced(self):
+        image = Image.open('input.jpg').resize((2400, 1600))
+        result = ImageWorker(operation={'filters': ['resize:200']}).apply_filters(image)
+        self.assertTrue(np.array_equal(np.asarray(result), np.asarray(ImageWorker.resize(image, '200'))))
+
+    def test_invalid_geometric_filter_in_chain(self):
+        with self.assertRaises(InvalidFlipDirectionError):
+            ImageWorker(operation={'filters': ['rotate:30', 'flip:nowhere']}).apply_filters(self.image)
+        # a filter with too many arguments is skipped, the others are still applied
+        result = ImageWorker(operation={'filters': ['flip:h', 'resize:10:10:best:fit:10']}).apply_filters(self.image)
+        self.assertTrue(np.array_equal(np.asarray(result), np.asarray(self.image.transpose(Image.FLIP_LEFT_RIGHT))))
+
+    def test_chain_validated_before_decoding(self):
+        image = Image.open('input.jpg')
+        with self.assertRaises(ValueError):
+            ImageWorker(operation={'input': image, 'filters': ['flip:h', 'resize:200', 'sepia:much']})
+        with self.assertRaises(FileNotFoundError):
+            ImageWorker(operation={'input': image, 'filters': ['overlay:missing.png:10,10']})
+        # nothing was decoded
+        self.assertTrue(image.tile)
+
+        self.assertEqual(validate_chain(['flip:h', 'blur', 'resize', 'sepia:0.5']), ['flip:h', 'sepia:0.5'])
+        with self.assertRaises(FilterNotImplementedError):
+            validate_chain(['flip:h', 'blur'], strict=True)
+        with self.assertRaises(InvalidNumberOfArgumentsError):
+            validate_chain(['resize'], strict=True)
+
+    def test_numpy_only_imported_when_needed(self):
+        # Pillow 10.3 and later may import numpy on its own, only what filter_image adds on top of it counts
+        script = ('import sys; from PIL import Image; before = "numpy" in sys.modules; '
+                  'from filter_image import ImageWorker; '
+                  'ImageWorker(operation={"filters": sys.argv[1:]}).apply_filters(Image.new("RGB", (8, 8))); '
+                  'print(before, "numpy" in sys.modules)')
+        for filters, needed in [(['flip:h', 'resize:4'], False), (['flip:h', 'sepia'], True)]:
+            output = subprocess.run([sys.executable, '-c', script] + filters, capture_output=True, text=True)
+            before, after = output.stdout.split()
+            self.assertEqual(after, str(needed or before == 'True'))
+
+        # the server, process pools and memory tracing are not needed to filter a single image either
+        script = ('import sys; import filter_image; print(sorted(name for name in ["http.server", "tracemalloc", '
+                  '"concurrent.futures.process"] if name in sys.modules))')
+        output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True)
+        self.assertEqual(output.stdout.strip(), '[]')
+
+
+class ArrayTests(unittest.TestCase):
+
+    def setUp(self):
+        self.image = Image.open('input.jpg').resize((150, 100))
+        self.pixels = np.asarray(self.image.convert('RGBA'))
+
+    def test_same_result_as_images(self):
+        chains = [['sepia:0.6', 'flip:h', 'sepia'], ['rotate:90:true', 'sepia', 'black_and_white:120'],
+                  ['resize:60', 'gray_scale'], ['flip:v', 'rotate:30', 'sepia:0.3']]
+        for filters in chains:
+            expected = ImageWorker(operation={'filters': filters}).apply_filters(self.image.convert('RGBA'))
+            result = filter_array(self.pixels, filters)
+            self.assertTrue(np.array_equal(result, np.asarray(expected.convert('L') if expected.mode == '1'
+                                                              else expected)), filters)
+
+    def test_transposes_are_views(self):
+        for method, view in TRANSPOSE_VIEWS.items():
+            expected = self.image.transpose(method) if method is not None else self.image
+            self.assertTrue(np.array_equal(view(np.asarray(self.image)), np.asarray(expected)), method)
+
+        result = filter_array(self.pixels, ['flip:h', 'rotate:90:true'])
+        self.assertTrue(np.shares_memory(result, self.pixels))
+        # RGBA and L images read the memory of the array instead of copying it
+        self.assertEqual(array_to_image(self.pixels).tobytes(), self.pixels.tobytes())
+
+    def test_buffers(self):
+        data = bytearray(self.image.tobytes())
+        result = filter_array(data, ['sepia'], size=self.image.size, mode='RGB')
+        self.assertEqual(result.shape, (100, 150, 3))
+        self.assertTrue(np.array_equal(result, np.asarray(ImageWorker.sepia(self.image))))
+        self.assertTrue(np.array_equal(filter_array(memoryview(np.asarray(self.image)), ['flip:h']),
+                                       np.asarray(self.image)[:, ::-1]))
+
+        with self.assertRaises(InvalidArrayError):
+            filter_array(data, ['sepia'], size=(10, 10), mode='RGB')
+        with self.assertRaises(InvalidArrayError):
+            filter_array(np.zeros((10, 10, 3), dtype=np.float32), ['sepia'])
+
+    def test_chain_validated_strictly(self):
+        with self.assertRaises(FilterNotImplementedError):
+            filter_array(self.pixels, ['blur', 'resize:20'])
+        with self.assertRaises(InvalidNumberOfArgumentsError):
+            filter_array(self.pixels, ['resize'])
+
+
+class StreamTests(unittest.TestCase):
+
+    def setUp(self):
+        self.image = Image.open('input.jpg').resize((60, 40))
+        self.stream = io.BytesIO()
+        self.image.save(self.stream, 'PPM')
+        self.image.convert('RGBA').save(self.stream, 'PNG')
+        self.image.convert('L').save(self.stream, 'PPM')
+
+    def test_concatenated_images(self):
+        self.stream.seek(0)
+        frames = list(FrameReader(self.stream))
+        self.assertEqual([frame.mode for frame in frames], ['RGB', 'RGBA', 'L'])
+        self.assertEqual(frames[0].tobytes(), self.image.tobytes())
+
+        self.stream.seek(0)
+        output = io.BytesIO()
+        self.assertEqual(filter_stream(self.stream, output, ['flip:h', 'sepia'], 'png'), 3)
+        output.seek(0)
+        results = list(FrameReader(output))
+        expected = ImageWorker(operation={'filters': ['flip:h', 'sepia']}).apply_filters(self.image.convert('RGBA'))
+        self.assertEqual(results[1].tobytes(), expected.tobytes())
+
+    def test_raw_frames_reuse_the_buffer(self):
+        data = self.image.tobytes() + self.image.transpose(Image.FLIP_TOP_BOTTOM).tobytes()
+        reader = FrameReader(io.BytesIO(data), (60, 40, 'RGB'))
+        first = reader.read()
+        buffer = reader.buffer
+        self.assertEqual(first.tobytes(), self.image.tobytes())
+        reader.read()
+        self.assertIs(reader.buffer, buffer)
+        self.assertIsNone(reader.read())
+
+        output = io.BytesIO()
+        filter_stream(io.BytesIO(data), output, ['flip:v'], 'raw', raw=(60, 40, 'RGB'))
+        self.assertEqual(output.getvalue(), data[len(data) // 2:] + data[:len(data) // 2])
+
+    def test_broken_streams(self):
+        with self.assertRaises(InvalidStreamError):
+            list(FrameReader(io.BytesIO(self.stream.getvalue()[:-10])))
+        with self.assertRaises(InvalidStreamError):
+            list(FrameReader(io.BytesIO(b'GIF89a')))
+        with self.assertRaises(InvalidStreamError):
+            list(FrameReader(io.BytesIO(bytes(100)), (6, 6, 'RGB')))
+        with self.assertRaises(FilterNotImplementedError):
+            filter_stream(io.BytesIO(), io.BytesIO(), ['blur'])
+
+    def test_stream_flags(self):
+        operation = InputParser(untreated_arguments=['-i', '-', '-f', 'sepia', '-r', '64x48:rgb', '-o', '-:raw'])
+        self.assertEqual(operation.requested_operation['raw'], (64, 48, 'RGB'))
+        self.assertEqual(operation.requested_operation['stream_format'], 'raw')
+        self.assertEqual(InputParser(untreated_arguments=['-i', '-']).requested_operation['stream_format'], 'ppm')
+        with self.assertRaises(InvalidRawFormatError):
+            InputParser(untreated_arguments=['-i', '-', '-r', '64x48:CMYK'])
+
+        result = subprocess.run([sys.executable, 'filter_image.py', '-i', '-', '-f', 'gray_scale', '-o', '-:png'],
+                                input=self.stream.getvalue(), stdout=subprocess.PIPE, check=True)
+        self.assertEqual(len(list(FrameReader(io.BytesIO(result.stdout)))), 3)
+
+
+class ProfileTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.input_path = join(self.directory.name, 'input.jpg')
+        Image.open('input.jpg').save(self.input_path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_profile_callback(self):
+        records = []
+        output = ImageWorker(operation={
+            'input': Image.open(self.input_path),
+            'filters': ['resize:200', 'flip:h', 'sepia', 'gray_scale'],
+            'output': 'result.png',
+            'output_dir': self.directory.name,
+            'show': False,
+            'profile': records.append
+        }).run()
+
+        self.assertTrue(exists(output))
+        self.assertEqual([record['stage'] for record in records], ['decode', 'filter', 'filter', 'encode', 'write'])
+        self.assertEqual(records[1]['filters'], ['resize:200', 'flip:h'])
+        self.assertEqual(records[2]['filters'], ['sepia', 'gray_scale'])
+        self.assertEqual(records[2]['size_before'], [200, 133])
+        self.assertEqual((records[2]['mode_before'], records[2]['mode_after']), ('RGB', 'L'))
+        for record in records:
+            self.assertEqual(record['input'], self.input_path)
+            self.assertEqual(record['output'], 'result.png')
+            for key in ['wall_seconds', 'cpu_seconds', 'allocated_bytes', 'max_rss_bytes']:
+                self.assertGreaterEqual(record[key], 0)
+        # tracing slows down every later allocation of the process, it does not outlive the stages
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_profile_without_reset_peak(self):
+        # tracemalloc of Python 3.8, without reset_peak()
+        older = types.SimpleNamespace(start=tracemalloc.start, stop=tracemalloc.stop,
+                                      is_tracing=tracemalloc.is_tracing, get_traced_memory=tracemalloc.get_traced_memory)
+        records = []
+        profiler = StageProfiler(records.append)
+        with unittest.mock.patch.dict(sys.modules, {'tracemalloc': older}):
+            profiler.measure('filter', ImageWorker.gray_scale, Image.open(self.input_path))
+            tracemalloc.start()
+            try:
+                # the peak may be older than the stage when someone else is tracing, it is left out then
+                profiler.measure('filter', ImageWorker.gray_scale, Image.open(self.input_path))
+            finally:
+                tracemalloc.stop()
+        self.assertGreaterEqual(records[0]['allocated_bytes'], 0)
+        self.assertIsNone(records[1]['allocated_bytes'])
+
+    def test_profile_json_lines(self):
+        profile_path = join(self.directory.name, 'profile.jsonl')
+        parser = InputParser(['-i', self.input_path, '-f', 'sepia', '-o', 'out.jpg', '-n', '-p', profile_path])
+        operation = dict(parser.requested_operation, output_dir=self.directory.name)
+        ImageWorker(operation=operation).run()
+        ImageWorker(operation=dict(operation, input=Image.open(self.input_path))).run()
+
+        with open(profile_path) as profile:
+            records = [json.loads(line) for line in profile]
+        self.assertEqual([record['stage'] for record in records], ['decode', 'filter', 'encode', 'write'] * 2)
+
+
+class FramesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.frames = []
+        for index in range(4):
+            frame = Image.new('RGB', (120, 80), (index * 60, 100, 200 - index * 40))
+            frame.paste((255, 255, 0), (index * 20, 10, index * 20 + 30, 40))
+            self.frames.append(frame)
+        self.gif_path = join(self.directory.name, 'animation.gif')
+        self.frames[0].save(self.gif_path, save_all=True, append_images=self.frames[1:], duration=[100, 200, 300, 400],
+                            loop=3, disposal=2)
+        self.tiff_path = join(self.directory.name, 'pages.tiff')
+        self.frames[0].save(self.tiff_path, save_all=True, append_images=self.frames[1:])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def run_worker(self, path: str, output: str, jobs: int) -> Image:
+        ImageWorker(operation={'input': Image.open(path), 'filters': ['resize:60', 'sepia'], 'output': output,
+                               'output_dir': self.directory.name, 'show': False, 'jobs': jobs}).run()
+        return Image.open(join(self.directory.name, output))
+
+    def test_animation_keeps_timing(self):
+        for jobs in [1, 2]:
+            with self.run_worker(self.gif_path, 'result.gif', jobs) as result:
+                self.assertEqual((result.n_frames, result.size, result.info['loop']), (4, (60, 40), 3))
+                timing = []
+                for index in range(result.n_frames):
+                    result.seek(index)
+                    timing.append((result.info['duration'], result.disposal_method))
+                self.assertEqual(timing, [(100, 2), (200, 2), (300, 2), (400, 2)])
+
+        with self.run_worker(self.gif_path, 'result.webp', 2) as result:
+            self.assertEqual((result.n_frames, result.info['loop']), (4, 3))
+
+    def test_frames_filtered_into_identical_ones(self):
+        # frames only differing by a blue shade gray scale to the same image, the gif encoder merges them
+        frames = [Image.new('RGB', (20, 20), (100, 100, 100 + index)) for index in range(3)]
+        frames[0].save(self.gif_path, save_all=True, append_images=frames[1:], duration=100, disposal=2)
+        ImageWorker(operation={'input': Image.open(self.gif_path), 'filters': ['gray_scale'], 'output': 'gray.gif',
+                               'output_dir': self.directory.name, 'show': False}).run()
+        with Image.open(join(self.directory.name, 'gray.gif')) as result:
+            self.assertEqual((result.n_frames, result.info['duration'], result.disposal_method), (1, 300, 2))
+
+    def test_every_page_filtered(self):
+        worker = ImageWorker(operation={'filters': ['resize:60', 'sepia']})
+        with self.run_worker(self.tiff_path, 'result.tiff', 2) as result:
+            self.assertEqual(result.n_frames, 4)
+            for index, frame in enumerate(self.frames):
+                result.seek(index)
+                self.assertEqual(result.tobytes(), worker.apply_filters(frame).tobytes())
+
+        # formats without frames keep the first one only
+        with self.run_worker(self.tiff_path, 'result.jpg', 2) as result:
+            self.assertEqual((getattr(result, 'n_frames', 1), result.size), (1, (60, 40)))
+
+
+class CacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.input_path = join(self.directory.name, 'input.jpg')
+        Image.open('input.jpg').save(self.input_path)
+        self.cache = ResultCache(join(self.directory.name, 'cache'))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def run_worker(self, filters: list, output: str = 'result.png') -> list:
+        records = []
+        ImageWorker(operation={
+            'input': Image.open(self.input_path),
+            'filters': filters,
+            'output': output,
+            'output_dir': self.directory.name,
+            'show': False,
+            'cache': self.cache,
+            'profile': records.append
+        }).run()
+        return [record['stage'] for record in records]
+
+    def test_result_hit_skips_decode(self):
+        self.assertEqual(self.run_worker(['resize:200', 'sepia']), ['decode', 'filter', 'filter', 'encode', 'write'])
+        expected = Image.open(join(self.directory.name, 'result.png')).tobytes()
+        # same chain spelled differently, still the same result
+        self.assertEqual(self.run_worker(['resize:200:', 'sepia'], 'again.png'), ['cache'])
+        self.assertEqual(Image.open(join(self.directory.name, 'again.png')).tobytes(), expected)
+
+    def test_prefix_reuse(self):
+        self.run_worker(['resize:200', 'sepia'])
+        self.assertEqual(self.run_worker(['resize:200', 'gray_scale']), ['decode', 'filter', 'encode', 'write'])
+        worker = ImageWorker(operation={'input': Image.open(self.input_path), 'filters': ['resize:200', 'gray_scale']})
+        reference = worker.apply_filters(Image.open(self.input_path))
+        self.assertEqual(Image.open(join(self.directory.name, 'result.png')).tobytes(), reference.tobytes())
+
+    def test_input_hashed_once(self):
+        with unittest.mock.patch('filter_image.file_digest', wraps=filter_image.file_digest) as digest:
+            self.run_worker(['resize:200', 'sepia', 'rotate:90:true', 'gray_scale'])
+            self.assertEqual(digest.call_count, 1)
+
+    def test_prefix_skipped_for_modes_png_cannot_store(self):
+        Image.open(self.input_path).convert('CMYK').save(self.input_path)
+        self.assertEqual(self.run_worker(['resize:100'], 'result.jpg'), ['decode', 'filter', 'encode', 'write'])
+        self.assertEqual(Image.open(join(self.directory.name, 'result.jpg')).mode, 'CMYK')
+        self.assertEqual(self.run_worker(['resize:100'], 'again.jpg'), ['cache'])
+
+    def test_lru_eviction(self):
+        cache = ResultCache(join(self.directory.name, 'small'), max_bytes=250)
+        first = cache.put(ResultCache.key('first'), '.bin', b'1' * 100)
+        second = cache.put(ResultCache.key('second'), '.bin', b'2' * 100)
+        os.utime(second, (0, 0))
+        self.assertTrue(cache.get(ResultCache.key('first'), '.bin'))
+        cache.put(ResultCache.key('third'), '.bin', b'3' * 100)
+        self.assertTrue(exists(first))
+        self.assertFalse(exists(second))
+        self.assertIsNone(cache.get(ResultCache.key('second'), '.bin'))
+
+    def test_eviction_scans_only_over_the_limit(self):
+        cache = ResultCache(join(self.directory.name, 'small'), max_bytes=250)
+        cache.put(ResultCache.key('first'), '.bin', b'1' * 100)
+        with unittest.mock.patch.object(cache, 'evict', wraps=cache.evict) as evict:
+            cache.put(ResultCache.key('second'), '.bin', b'2' * 100)
+            self.assertEqual(evict.call_count, 0)
+            cache.put(ResultCache.key('third'), '.bin', b'3' * 100)
+            self.assertEqual(evict.call_count, 1)
+        self.assertEqual(cache.total, 200)
+
+    def test_worker_processes_share_the_total(self):
+        self.run_worker(['resize:200'])
+        # the cache as the pool hands it to every task of a batch or watch
+        with unittest.mock.patch.object(ResultCache, 'evict', autospec=True, side_effect=ResultCache.evict) as evict:
+            for number in range(3):
+                options = {'cache': pickle.loads(pickle.dumps(self.cache))}
+                report = process_image_file(self.input_path, ['resize:' + str(100 + number)], 'task.png',
+                                            self.directory.name, options)
+                self.assertIsNone(report['error'])
+            self.assertEqual(evict.call_count, 0)
+
+        cache = pickle.loads(pickle.dumps(self.cache))
+        stored = sum(os.path.getsize(join(folder, name)) for folder, _, names in os.walk(self.cache.directory)
+                     for name in names if name != ResultCache.size_name)
+        self.assertEqual(cache.add_size(0), stored)
+
+    def test_cache_flag(self):
+        parser = InputParser(['-i', self.input_path, '-f', 'sepia', '-c', 'somewhere:2'])
+        self.assertEqual(parser.requested_operation['cache'].directory, 'somewhere')
+        self.assertEqual(parser.requested_operation['cache'].max_bytes, 2 * 1024 * 1024)
+        with self.assertRaises(InvalidCacheSizeError):
+            InputParser(['-i', self.input_path, '-f', 'sepia', '-c', 'somewhere:none'])
+
+
+class WatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.spool = join(self.directory.name, 'spool')
+        os.makedirs(self.spool)
+        for name in ['first.jpg', 'second.jpg']:
+            Image.open('input.jpg').save(join(self.spool, name))
+        self.operation = {'watch': 0, 'watch_dir': self.spool, 'filters': ['resize:100'], 'output': 'thumbs.png',
+                          'output_dir': self.directory.name, 'jobs': 1}
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def processed(self, operation: dict = None) -> list:
+        worker = WatchWorker(operation or self.operation)
+        return sorted(basename(report['input']) for report in worker.process(worker.scan()))
+
+    def test_only_new_or_changed_images(self):
+        self.assertEqual(self.processed(), ['first.jpg', 'second.jpg'])
+        self.assertEqual(Image.open(join(self.directory.name, 'thumbs', 'first.png')).width, 100)
+        # a restart remembers what was done
+        self.assertEqual(self.processed(), [])
+
+        os.utime(join(self.spool, 'first.jpg'))
+        Image.open('input.jpg').rotate(90).save(join(self.spool, 'second.jpg'))
+        Image.open('input.jpg').save(join(self.spool, 'third.jpg'))
+        self.assertEqual(self.processed(), ['second.jpg', 'third.jpg'])
+        self.assertEqual(self.processed(dict(self.operation, filters=['resize:50'])),
+                         ['first.jpg', 'second.jpg', 'third.jpg'])
+
+    def test_restart_after_crash(self):
+        self.processed()
+        index_path = join(self.directory.name, 'thumbs', WatchWorker.index_name)
+        with open(index_path) as index_file:
+            lines = index_file.readlines()
+        # second.jpg was being recorded when the process died
+        with open(index_path, 'w') as index_file:
+            index_file.write(lines[0] + lines[1][:20])
+        self.assertEqual(self.processed(), ['second.jpg'])
+        self.assertEqual(len(open(index_path).readlines()), 2)
+
+    def test_every_image_recorded_when_done(self):
+        process_image_file = filter_image.process_image_file
+
+        def crash_on_second_image(path, *arguments):
+            if basename(path) == 'more_0.jpg':
+                raise KeyboardInterrupt
+            return process_image_file(path, *arguments)
+
+        # enough images for the batch mode to put several of them in every chunk
+        for number in range(6):
+            Image.open('input.jpg').resize((60, 40)).save(join(self.spool, 'more_' + str(number) + '.jpg'))
+        worker = WatchWorker(self.operation)
+        with unittest.mock.patch('filter_image.process_image_file', crash_on_second_image):
+            with self.assertRaises(KeyboardInterrupt):
+                worker.process(worker.scan())
+        # first.jpg was finished before the crash, it is not processed again
+        self.assertNotIn('first.jpg', self.processed())
+
+    def test_files_being_written_wait(self):
+        worker = WatchWorker(dict(self.operation, watch=60))
+        self.assertEqual(worker.scan(), [])
+        self.assertEqual(len(worker.scan()), 2)
+
+    def test_watch_flag(self):
+        operation = InputParser(['-i', self.spool, '-w', '-f', 'sepia', '-o', 'thumbs:png']).requested_operation
+        self.assertEqual((operation['watch'], operation['watch_dir']), (2.0, self.spool))
+        self.assertEqual(InputParser(['-i', self.spool, '-w', '0.5', '-o', 'thumbs:png']).requested_operation['watch'],
+                         0.5)
+        with self.assertRaises(InvalidWatchError):
+            InputParser(['-i', 'input.jpg', '-w', '-o', 'thumbs:png'])
+        with self.assertRaises(InvalidWatchError):
+            InputParser(['-i', self.spool, '-w', 'often', '-o', 'thumbs:png'])
+        # without an output name every run would get a new folder and an empty index
+        with self.assertRaises(InvalidWatchError):
+            InputParser(['-i', self.spool, '-w'])
+
+    def test_index_survives_another_working_directory(self):
+        self.processed()
+        current = os.getcwd()
+        os.chdir(self.directory.name)
+        try:
+            self.assertEqual(self.processed(dict(self.operation, watch_dir='spool')), [])
+            self.assertEqual(self.processed(dict(self.operation, watch_dir='./spool/')), [])
+        finally:
+            os.chdir(current)
+
+
+class ServerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FilterServer(('127.0.0.1', 0), jobs=2, queue_size=0)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:' + str(self.server.server_address[1])
+        with open('input.jpg', 'rb') as input_file:
+            self.data = input_file.read()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def post(self, query: str):
+        return urllib.request.urlopen(urllib.request.Request(self.url + '/?' + query, data=self.data))
+
+    def test_filters_posted_image(self):
+        with self.post('f=resize:200&f=sepia&format=png') as response:
+            self.assertEqual(response.headers['Content-Type'], 'image/png')
+            result = Image.open(io.BytesIO(response.read()))
+
+        worker = ImageWorker(operation={'filters': ['resize:200', 'sepia']})
+        expected = worker.apply_filters(Image.open('input.jpg'))
+        self.assertEqual(result.tobytes(), expected.tobytes())
+
+    def test_bad_requests(self):
+        for query in ['f=blur', 'f=resize', 'f=flip:sideways', 'f=sepia&format=bmp']:
+            with self.assertRaises(urllib.error.HTTPError) as context:
+                self.post(query)
+            self.assertEqual(context.exception.code, 400)
+
+    def test_busy_server(self):
+        for _ in range(2):
+            self.server.slots.acquire()
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            self.post('f=sepia')
+        self.assertEqual(context.exception.code, 503)
+        self.assertEqual(context.exception.headers['Retry-After'], '1')
+
+        # refused before the body is read, a client announcing a huge upload gets its answer right away
+        with socket.create_connection(self.server.server_address, timeout=5) as connection:
+            connection.sendall(b'POST /?f=sepia HTTP/1.1\r\nHost: test\r\nContent-Length: 100000000\r\n\r\n')
+            answer = connection.recv(4096)
+        self.assertTrue(answer.startswith(b'HTTP/1.1 503'))
+        self.assertIn(b'Connection: close', answer)
+
+        self.server.slots.release()
+        # a negative length is refused before taking the slot, which stays free for the next request
+        with socket.create_connection(self.server.server_address, timeout=5) as connection:
+            connection.sendall(b'POST /?f=sepia HTTP/1.1\r\nHost: test\r\nContent-Length: -1\r\n\r\n')
+            answer = connection.recv(4096)
+        self.assertTrue(answer.startswith(b'HTTP/1.1 400'))
+        with self.post('f=sepia') as response:
+            self.assertEqual(response.status, 200)
+
+    def test_overlay_not_allowed(self):
+        for query in ['f=overlay:python.png', 'f=sepia&f=overlay:/etc/passwd:0,0']:
+            with self.assertRaises(urllib.error.HTTPError) as context:
+                self.post(query)
+            self.assertEqual(context.exception.code, 400)
+            self.assertIn(b'FilterNotAllowedError', context.exception.read())
+
+    def test_serve_flag(self):
+        self.assertEqual(InputParser(['-s', '8080', '-j', '4']).requested_operation['serve'], ('127.0.0.1', 8080))
+        self.assertEqual(InputParser(['--serve', '0.0.0.0:80']).requested_operation['serve'], ('0.0.0.0', 80))
+        with self.assertRaises(InvalidServerAddressError):
+            InputParser(['-s', 'localhost'])
+
+
+class BatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.inputs = []
+        image = Image.open('input.jpg').resize((120, 80))
+        for name in ['first.jpg', 'second.png']:
+            image.save(join(self.directory.name, name))
+            self.inputs.append(join(self.directory.name, name))
+        with open(join(self.directory.name, 'broken.jpg'), 'w') as broken:
+            broken.write('not an image')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_input_directory(self):
+        parser = InputParser(['-i', self.directory.name, '-f', 'gray_scale', '-j', '2'])
+        operation = parser.requested_operation
+        self.assertEqual(len(operation['inputs']), 3)
+        self.assertEqual(operation['jobs'], 2)
+        self.assertNotIn('input', operation)
+
+    def test_input_glob_and_list(self):
+        parser = InputParser(['-i', join(self.directory.name, '*.png')])
+        self.assertEqual(parser.requested_operation['inputs'], [self.inputs[1]])
+
+        list_path = join(self.directory.name, 'paths.txt')
+        with open(list_path, 'w') as list_file:
+            list_file.write("\n".join(self.inputs) + "\n")
+        parser = InputParser(['-i', '@' + list_path])
+        self.assertEqual(parser.requested_operation['inputs'], self.inputs)
+
+    def test_single_input_is_not_a_batch(self):
+        parser = InputParser(['-i', 'input.jpg', '--no-show'])
+        self.assertIsInstance(parser.requested_operation['input'], Image.Image)
+        self.assertFalse(parser.requested_operation['show'])
+
+        # a file whose name looks like a glob pattern is still a single image
+        path = join(self.directory.name, 'photo[1].jpg')
+        Image.open('input.jpg').save(path)
+        parser = InputParser(['-i', path, '-n'])
+        self.assertEqual(parser.requested_operation['input'].filename, path)
+
+    def test_memory_budget(self):
+        parser = InputParser(['-i', 'input.jpg', '--memory', '256'])
+        self.assertEqual(parser.requested_operation['memory_budget'], 256 * 1024 * 1024)
+        with self.assertRaises(InvalidMemoryBudgetError):
+            InputParser(['-i', 'input.jpg', '-m', 'lots'])
+
+    def test_encoder_options(self):
+        operation = InputParser(['-i', 'input.jpg', '-o', 'thumb.jpg:quality=80:progressive']).requested_operation
+        self.assertEqual(operation['output'], 'thumb.jpg')
+        self.assertEqual(operation['encoder'], {'quality': 80, 'progressive': True})
+        operation = InputParser(['-i', 'input.jpg', '-o', 'thumb:webp:fast:lossless=false']).requested_operation
+        self.assertEqual(operation['output'], 'thumb.webp')
+        self.assertEqual(operation['encoder'], {'method': 0, 'lossless': False})
+        self.assertEqual(InputParser(['-i', 'input.jpg', '-o', 'thumb:PNG']).requested_operation['encoder'], {})
+        self.assertEqual(encoder_options('png', ['small', 'compress_level=3']), {'optimize': True,
+                                                                                 'compress_level': 3})
+        # jpg defaults are already its fastest settings
+        self.assertEqual(encoder_options('jpg', ['fast']), {})
+
+        for output in ['thumb.png:quality=80', 'thumb.jpg:quality=high', 'thumb:png:method=2']:
+            with self.assertRaises(InvalidEncoderOptionError):
+                InputParser(['-i', 'input.jpg', '-o', output])
+
+        ImageWorker(operation={'input': Image.open('input.jpg'), 'output': 'thumb.jpg', 'show': False,
+                               'output_dir': self.directory.name,
+                               'encoder': {'quality': 30, 'progressive': True}}).run()
+        with Image.open(join(self.directory.name, 'thumb.jpg')) as result:
+            self.assertTrue(result.info.get('progressive'))
+
+    def test_background_writer(self):
+        output_dir = join(self.directory.name, 'results')
+        reports = BatchWorker(operation={
+            'inputs': self.inputs,
+            'filters': ['resize:60'],
+            'output': 'thumbs.webp',
+            'output_dir': output_dir,
+            'encoder': {'quality': 50},
+            'jobs': 1
+        }).run()
+        self.assertFalse([report for report in reports if report['error']])
+        for name in ['first.webp', 'second.webp']:
+            with Image.open(join(output_dir, 'thumbs', name)) as result:
+                self.assertEqual((result.format, result.size), ('WEBP', (60, 40)))
+
+        # errors writing are reported for the image they belong to
+        writer = BackgroundWriter()
+        writer.submit('first', write_file, b'data', join(self.directory.name, 'first.jpg', 'nested.png'))
+        writer.submit('second', write_file, b'data', join(output_dir, 'second.png'))
+        self.assertEqual(list(writer.close()), ['first'])
+        self.assertTrue(exists(join(output_dir, 'second.png')))
+
+    def test_invalid_number_of_jobs(self):
+        with self.assertRaises(InvalidNumberOfJobsError):
+            InputParser(['-i', 'input.jpg', '-j', 'many'])
+        with self.assertRaises(InvalidNumberOfJobsError):
+            InputParser(['-i', 'input.jpg', '-j', '0'])
+
+    def test_batch_reports_errors_per_file(self):
+        output_dir = join(self.directory.name, 'results')
+        for jobs in [1, 2]:
+            reports = BatchWorker(operation={
+                'inputs': sorted(self.inputs + [join(self.directory.name, 'broken.jpg')]),
+                'filters': ['resize:60', 'gray_scale', 'unknown_filter'],
+                'output': 'thumbs.png',
+                'output_dir': output_dir,
+                'jobs': jobs
+            }).run()
+
+            self.assertEqual(len(reports), 3)
+            failed = [report for report in reports if report['error']]
+            self.assertEqual([report['input'] for report in failed], [join(self.directory.name, 'broken.jpg')])
+            for name in ['first.png', 'second.png']:
+                path = join(output_dir, 'thumbs', name)
+                self.assertTrue(exists(path))
+                with Image.open(path) as result:
+                    self.assertEqual(result.size, (60, 40))
+                    self.assertEqual(result.mode, 'L')
+
+
+class BenchmarkTests(unittest.TestCase):
+
+    def test_synthetic_images(self):
+        for mode in benchmark.MODES:
+            image = benchmark.synthetic_image((64, 48), mode)
+            self.assertEqual(image.mode, mode)
+            self.assertEqual(image.size, (64, 48))
+            self.assertEqual(image.tobytes(), benchmark.synthetic_image((64, 48), mode).tobytes(),
+                             "Should be the same image every time")
+
+    def test_run_case(self):
+        result = benchmark.run_case(benchmark.CHAIN_CASES['watermark'], (64, 48), 'RGB', repeat=2)
+        self.assertGreater(result['seconds'], 0)
+        self.assertGreater(result['megapixels_per_second'], 0)
+        self.assertGreaterEqual(result['peak_memory_mb'], 0)
+
+    def test_isolated_cases(self):
+        results = benchmark.run_benchmarks(['small'], ['L'], {'flip': ['flip:h'], 'sepia': ['sepia']}, repeat=1)
+        self.assertEqual(sorted(results), ['flip/L/small', 'sepia/L/small'])
+
+    def test_compare_with_baseline(self):
+        baseline = {'sepia/RGB/small': {'seconds': 1.0}, 'flip/RGB/small': {'seconds': 1.0}}
+        results = {'sepia/RGB/small': {'seconds': 1.5}, 'flip/RGB/small': {'seconds': 1.05},
+                   'resize/RGB/small': {'seconds': 3.0}}
+        regressions = benchmark.compare(results, baseline, threshold=0.1)
+        self.assertEqual([regression[0] for regression in regressions], ['sepia/RGB/small'])
+
+    def test_thread_scaling(self):
+        results = benchmark.run_benchmarks(['small'], ['RGB'], {'sepia': ['sepia']}, repeat=1, isolated=False,
+                                           threads=[1, 2])
+        self.assertEqual(sorted(results), ['sepia/RGB/small/t1', 'sepia/RGB/small/t2'])
+        self.assertEqual(sorted(benchmark.scaling(results)), ['sepia/RGB/small/t1', 'sepia/RGB/small/t2'])
+
+    def test_resize_qualities(self):
+        results = benchmark.run_quality((320, 240), 'RGB', repeat=1)
+        self.assertEqual(list(results), list(RESIZE_QUALITIES))
+        self.assertEqual(results['best']['psnr_db'], float('inf'))
+        self.assertGreater(results['balanced']['psnr_db'], results['nearest']['psnr_db'])
+
+    def test_run_startup(self):
+        result = benchmark.run_startup(benchmark.STARTUP_CASES['flip'], repeat=1)
+        self.assertGreater(result['seconds'], 0)
+
+
 if __name__ == '__main__':
     unittest.main()